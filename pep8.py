@@ -69,8 +69,13 @@ The example above also demonstrates how check plugins can request
 additional information with extra arguments. All attributes of the
 Checker object are available. Some examples:
 
-lines: a list of the raw lines from the input file
+lines: the raw lines from the input file, as a list or as SourceLines,
+    which support len(), iteration, indexing, slicing and + like a list
 tokens: the tokens that contribute to this logical line
+token_buffer: the same tokens, stored in parallel tuples, with the
+    depth of brackets at each offset of the logical line (see TokenBuffer)
+logical_candidates: offsets in the logical line, for each check with a
+    candidate_regex (see build_scanner)
 line_number: line number in the input file
 blank_lines: blank lines before this one
 indent_char: first indentation character in this file (' ' or '\t')
@@ -78,6 +83,28 @@ indent_level: indentation (with tabs expanded to multiples of 8)
 previous_indent_level: indentation on previous line
 previous_logical: previous logical line
 
+A physical line check can declare a candidate_regex that matches on
+every line where it may find an error.  It is then skipped on all the
+other lines, see Check.candidates().  A logical line check can declare
+one too, which matches where an error may be found in the logical line.
+It is then skipped on the logical lines without a match, and it can ask
+for the offsets of the matches with the logical_candidates argument,
+see build_scanner().
+
+A check can also have a fix() method, which takes the checker and the
+same arguments as check().  It is called in --fix mode when check()
+finds an error, and returns a list of edits (offset, length, text) to
+the line it was given: length characters at offset are replaced with
+text.  The edits of all checks are applied to the line in one pass, see
+apply_edits().  A check's edits are applied all together or not at all:
+if one of them conflicts with the edits of an earlier check, they are
+all dropped, see merge_edits().
+
+Checks can also live in other packages, which declare them in the
+'pep8.checks' entry point group with the codes they report, see
+find_plugins().  A plugin is imported only if some of its codes are
+selected.
+
 The docstring of each check object shall be the relevant part of
 text from PEP 8. It is printed if the user enables --show-pep8.
 Several docstrings contain examples directly from the PEP 8 document.
@@ -98,34 +125,76 @@ __version__ = '0.5.1dev'
 
 import os
 import sys
+import stat
 import re
 import time
-import inspect
 import keyword
 import tokenize
-from optparse import OptionParser
-from fnmatch import fnmatch
-from StringIO import StringIO
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from optparse import OptionParser, Values
+from fnmatch import translate
 try:
     frozenset
 except NameError:
     from sets import ImmutableSet as frozenset
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class LazyRegex(object):
+    """
+    A regular expression which is compiled when it is first used: most
+    runs need only some of them, and compiling all of them would slow
+    down the startup.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name):
+        # Called once for each method, which is then found in __dict__
+        method = getattr(re.compile(self.pattern, self.flags), name)
+        setattr(self, name, method)
+        return method
 
 
 DEFAULT_EXCLUDE = '.svn,CVS,.bzr,.hg,.git'
 DEFAULT_IGNORE = 'E24'
 MAX_LINE_LENGTH = 120
-
-INDENT_REGEX = re.compile(r'^([ \t]*)')
-RAISE_COMMA_REGEX = re.compile(r'raise\s+(\w+)\s*,\s*(.*)\s*')
-SELFTEST_REGEX = re.compile(r'(Okay|[EW]\d{3}):\s(.*)')
-ERRORCODE_REGEX = re.compile(r'[EW]\d{3}')
-DOCSTRING_REGEX = re.compile(r'u?r?["\']')
+DEFAULT_CACHE_SIZE = 64
+REPORT_BUFFER_SIZE = 1024
+TEST_SERIAL_SECONDS = 0.2
+TEST_CHUNK_SIZE = 8
+MMAP_THRESHOLD = 1024 * 1024
+FILE_LIST_CHUNK_SIZE = 65536
+WATCH_INTERVAL = 1.0
+STARTUP_RUNS = 20
+PLUGIN_GROUP = 'pep8.checks'
+
+INDENT_REGEX = LazyRegex(r'^([ \t]*)')
+NEWLINE_REGEX = LazyRegex(r'\n')
+INDENT_CHAR_REGEX = LazyRegex(r'^[ \t]', re.MULTILINE)
+TAB_INDENT_REGEX = LazyRegex(r'^[ \t]*\t', re.MULTILINE)
+SPACE_INDENT_REGEX = LazyRegex(r'^[ \t]* ', re.MULTILINE)
+COMMA_WHITESPACE_REGEX = LazyRegex(r'[,;:][ \t]+(?!#)')
+RAISE_COMMA_REGEX = LazyRegex(r'raise\s+(\w+)\s*,\s*(.*)\s*')
+SELFTEST_REGEX = LazyRegex(r'(Okay|[EW]\d{3}):\s(.*)')
+ERRORCODE_REGEX = LazyRegex(r'[EW]\d{3}')
+DOCSTRING_REGEX = LazyRegex(r'u?r?["\']')
+HUNK_REGEX = LazyRegex(r'^@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
 WHITESPACE_AROUND_OPERATOR_REGEX = \
-    re.compile('([^\w\s]*)\s*(\t|  )\s*([^\w\s]*)')
-EXTRANEOUS_WHITESPACE_REGEX = re.compile(r'[\[\(\{] | [\]\}\)\,\;\:]+')
+    LazyRegex('([^\w\s]*)\s*(\t|  )\s*([^\w\s]*)')
+EXTRANEOUS_WHITESPACE_REGEX = LazyRegex(r'[\[\(\{] | [\]\}\)\,\;\:]+')
 WHITESPACE_AROUND_NAMED_PARAMETER_REGEX = \
-    re.compile(r'[()]|\s=[^=]|[^=!<>]=\s')
+    LazyRegex(r'\s=[^=]|[^=!<>]=\s')
 
 
 WHITESPACE = ' \t'
@@ -136,14 +205,20 @@ BINARY_OPERATORS = frozenset(['**=', '*=', '+=', '-=', '!=', '<>',
     '%',  '^',  '&',  '|',  '=',  '/',  '//',  '<',  '>',  '<<'])
 UNARY_OPERATORS = frozenset(['>>', '**', '*', '+', '-'])
 OPERATORS = BINARY_OPERATORS | UNARY_OPERATORS
+BRACKETS = frozenset('([{}])')
 SKIP_TOKENS = frozenset([tokenize.NL, tokenize.INDENT,
                          tokenize.DEDENT, tokenize.NEWLINE])
+# Errors which stop checking a file, but not --watch
+CHECK_ERRORS = (tokenize.TokenError, SyntaxError, EnvironmentError)
 E225NOT_KEYWORDS = (frozenset(keyword.kwlist + ['print']) -
                     frozenset(['False', 'None', 'True']))
 BENCHMARK_KEYS = ('directories', 'files', 'logical lines', 'physical lines')
 
 options = None
 args = None
+checker = None
+plugin_entries = None
+loaded_plugins = set()
 
 
 # check registry
@@ -164,25 +239,256 @@ class Check(object):
     __metaclass__ = CheckMeta
 
     codes = []
+    # A physical line check can declare a regular expression with
+    # re.MULTILINE which matches on every line where check() may find an
+    # error.  The other lines are skipped, see Checker.find_candidates().
+    # A logical line check can declare a regular expression without
+    # groups, which matches where check() may find an error in the
+    # logical line.  The other logical lines are skipped, see
+    # build_scanner().
+    candidate_regex = None
+
+    def candidates(self, source, lines):
+        """
+        Return offsets in source which fall on the physical lines where
+        check() may find an error, or None to check every line.
+        """
+        if self.candidate_regex is None:
+            return None
+        return [match.start() for match in
+                self.candidate_regex.finditer(source)]
+
+
+def function_arguments(function):
+    """
+    Return the argument names of a function or method, like
+    inspect.getargspec(function)[0], without importing inspect.
+
+    >>> function_arguments(Check.candidates)
+    ['self', 'source', 'lines']
+    """
+    try:
+        code = function.__code__
+    except AttributeError:
+        code = function.func_code  # Python < 2.6
+    return list(code.co_varnames[:code.co_argcount])
 
 
-def find_checks(argument_name):
+def find_checks(argument_name, options):
     """
     Find all checks where the first argument name starts with argument_name.
     """
 
     checks = []
     for check in Check.all_checks:
-        args = inspect.getargspec(check.check)[0][1:]
+        args = function_arguments(check.check)[1:]
         if args and args[0].startswith(argument_name):
             for code in check.codes or ['']:
-                if not code or not ignore_code(code):
+                if not code or not ignore_code(code, options):
                     checks.append((check.__class__.__name__, check, args))
                     break
     checks.sort()
     return checks
 
 
+def find_plugins():
+    """
+    Find the plugins declared by the installed distributions in the entry
+    point group 'pep8.checks'.  Return a list of (codes, module, attr).
+
+    The name of each entry point lists the codes of its checks, separated
+    by commas, for example in setup.py:
+
+    entry_points={'pep8.checks': ['X101,X102 = acme.checks:spam_check']}
+
+    The entry_points.txt files on sys.path are read directly, because
+    importing pkg_resources takes longer than most runs of pep8.
+    """
+    plugins = []
+    seen = set()
+    for path in sys.path:
+        path = os.path.abspath(path or os.curdir)
+        if path in seen:
+            continue
+        seen.add(path)
+        try:
+            names = os.listdir(path)
+        except OSError:
+            continue
+        for name in sorted(names):
+            if os.path.splitext(name)[1] in ('.egg-info', '.dist-info'):
+                for plugin in read_entry_points(
+                        os.path.join(path, name, 'entry_points.txt')):
+                    if plugin not in plugins:
+                        plugins.append(plugin)
+    return plugins
+
+
+def read_entry_points(filename, group=PLUGIN_GROUP):
+    """
+    Return the entry points of the group in an entry_points.txt file, as
+    a list of (codes, module, attr).  The extras are not checked.
+    """
+    try:
+        lines = open(filename).readlines()
+    except IOError:
+        return []
+    entries = []
+    section = None
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if line.startswith('['):
+            section = line.strip('[]').strip()
+        elif section == group and '=' in line:
+            name, value = line.split('=', 1)
+            value = value.split('[')[0].strip()
+            if ':' in value:
+                module, attr = value.split(':', 1)
+            else:
+                module, attr = value, ''
+            entries.append(([code.strip() for code in name.split(',')],
+                            module.strip(), attr.strip()))
+    return entries
+
+
+def load_plugins(options):
+    """
+    Import the plugins with at least one code which is not ignored by the
+    options.  The Check subclasses they define are registered by CheckMeta
+    on import, and find_checks() returns them like the checks of pep8.
+    """
+    global plugin_entries
+    if plugin_entries is None:
+        plugin_entries = find_plugins()
+    # Plugins subclass pep8.Check, also when pep8.py runs as a script
+    sys.modules.setdefault('pep8', sys.modules[__name__])
+    for codes, module, attr in plugin_entries:
+        if (module, attr) in loaded_plugins:
+            continue
+        for code in codes:
+            if not match_ignore_prefixes(code, options):
+                break
+        else:
+            continue
+        plugin = __import__(module, {}, {}, ['__name__'])
+        for name in attr and attr.split('.') or []:
+            plugin = getattr(plugin, name)
+        loaded_plugins.add((module, attr))
+
+
+def compile_check(check, argument_names, scanned=False):
+    """
+    Return a function which calls check.check() with the attributes of a
+    Checker named by argument_names, without looking them up by name.
+    If scanned, the check is only called when the scanner found some
+    candidates for it.
+    """
+    source = 'check(%s)' % ', '.join(
+        ['checker.' + argument_name for argument_name in argument_names])
+    if scanned:
+        source = 'checker.logical_candidates.get(instance) and ' + source
+    return eval('lambda checker: ' + source,
+                {'check': check.check, 'instance': check})
+
+
+def build_plan(checks, scanned=False):
+    """
+    Build the dispatch plan for the checks returned by find_checks().
+    If scanned, the logical checks with a candidate_regex are skipped
+    when the scanner finds no candidates for them.
+    """
+    return [(name, check, argument_names,
+             compile_check(check, argument_names,
+                           scanned and check.candidate_regex is not None))
+            for name, check, argument_names in checks]
+
+
+def build_scanner(checks):
+    """
+    Combine the candidate_regex of the logical checks into one regular
+    expression, which finds the candidates of all these checks in a
+    single pass over the logical line.
+
+    Return a function which takes a logical line, and returns a dict
+    which maps each check with candidates to the list of their offsets.
+    Each offset is found even if the matches of several checks start
+    there, or overlap.
+    """
+    scanned = [check for name, check, argument_names in checks
+               if check.candidate_regex is not None]
+    if not scanned:
+        return lambda line: {}
+    patterns = [check.candidate_regex.pattern for check in scanned]
+    # Stop only where a check matches, then try each check there
+    regex = re.compile('(?=%s)' % '|'.join(patterns) + ''.join(
+        ['(?:(?=(%s)))?' % pattern for pattern in patterns]))
+
+    def scan(line):
+        found = {}
+        for match in regex.finditer(line):
+            offset = match.start()
+            for check, group in zip(scanned, match.groups()):
+                if group is not None:
+                    found.setdefault(check, []).append(offset)
+        return found
+    return scan
+
+
+def profile_check(name, run, profile, instance=None):
+    """
+    Wrap the function which runs a check, to record in the profile its
+    calls, hits, total and maximum time.  If instance is given, the check
+    runs only when the scanner found candidates for instance, as with
+    compile_check(), and only these calls are counted.
+    """
+    stats = profile.setdefault(name, [0, 0, 0.0, 0.0])
+    timer = time.time
+
+    def timed_run(checker):
+        if (instance is not None and
+                not checker.logical_candidates.get(instance)):
+            return None
+        start = timer()
+        result = run(checker)
+        add_timing(stats, timer() - start, result is not None)
+        return result
+    return timed_run
+
+
+def profile_scan(name, scan, profile):
+    """
+    Wrap a function which finds candidates, Check.candidates() or the
+    scanner of build_scanner(), to record in the profile its calls, hits
+    (the calls which found some), total and maximum time.  The calls which
+    return None, for a check without candidates, are not recorded.
+    """
+    timer = time.time
+
+    def timed_scan(*args):
+        start = timer()
+        result = scan(*args)
+        elapsed = timer() - start
+        if result is not None:
+            add_timing(profile.setdefault(name, [0, 0, 0.0, 0.0]),
+                       elapsed, bool(result))
+        return result
+    return timed_scan
+
+
+def add_timing(stats, elapsed, hit):
+    """
+    Count a call which took elapsed seconds in the stats of a profile.
+    """
+    stats[0] += 1
+    if hit:
+        stats[1] += 1
+    stats[2] += elapsed
+    if elapsed > stats[3]:
+        stats[3] = elapsed
+
+
 ##############################################################################
 # Plugins (check functions) for physical lines
 ##############################################################################
@@ -204,6 +510,17 @@ class tabs_or_spaces(Check):
     """
     codes = ['E101']
 
+    def candidates(self, source, lines):
+        # The first indented line decides which indent_char is wrong
+        match = INDENT_CHAR_REGEX.search(source)
+        if match is None:
+            return []
+        if match.group() == ' ':
+            regex = TAB_INDENT_REGEX
+        else:
+            regex = SPACE_INDENT_REGEX
+        return [match.start() for match in regex.finditer(source)]
+
     def check(self, physical_line, indent_char):
         indent = INDENT_REGEX.match(physical_line).group(1)
         for offset, char in enumerate(indent):
@@ -212,9 +529,10 @@ class tabs_or_spaces(Check):
 
     def fix(self, checker, physical_line, indent_char):
         indent = INDENT_REGEX.match(physical_line).group(1)
-        fixed = indent.replace('\t', '    ') + physical_line[len(indent):]
-        checker.report_fix("mixed tabs and spaces converted to all spaces.", physical_line, fixed)
-        return fixed
+        edits = [(0, len(indent), indent.replace('\t', '    '))]
+        checker.report_fix("mixed tabs and spaces converted to all spaces.",
+                           physical_line, edits)
+        return edits
 
 
 class tabs_obsolete(Check):
@@ -226,6 +544,7 @@ class tabs_obsolete(Check):
     W191: if True:\n\treturn
     """
     codes = ['W191']
+    candidate_regex = TAB_INDENT_REGEX
 
     def check(self, physical_line):
         indent = INDENT_REGEX.match(physical_line).group(1)
@@ -233,9 +552,10 @@ class tabs_obsolete(Check):
             return indent.index('\t'), "W191 indentation contains tabs"
 
     def fix(self, checker, physical_line):
-        fixed = physical_line.replace("\t", "    ")
-        checker.report_fix("tab converted to 4 spaces.", physical_line, fixed)
-        return fixed
+        indent = INDENT_REGEX.match(physical_line).group(1)
+        edits = [(0, len(indent), indent.replace('\t', '    '))]
+        checker.report_fix("tab converted to 4 spaces.", physical_line, edits)
+        return edits
 
 
 class trailing_whitespace(Check):
@@ -258,6 +578,7 @@ class trailing_whitespace(Check):
     W293: class Foo(object):\n    \n    bang = 12
     """
     codes = ['W291', 'W293']
+    candidate_regex = LazyRegex(r'[^\S\n]$', re.MULTILINE)
 
     def check(self, physical_line):
         physical_line = physical_line.rstrip('\n')    # chr(10), newline
@@ -271,9 +592,13 @@ class trailing_whitespace(Check):
                 return 0, "W293 blank line contains whitespace"
 
     def fix(self, checker, physical_line):
-        fixed = re.sub(r'[ \n\r\t]+$', "\n", physical_line)
-        checker.report_fix("whitespace stripped from end of line.", physical_line, fixed)
-        return fixed
+        stripped = physical_line.rstrip(' \n\r\t')
+        # The newline is added by missing_newline if there is none
+        edits = [(len(stripped), len(physical_line) - len(stripped),
+                  physical_line.endswith('\n') and '\n' or '')]
+        checker.report_fix("whitespace stripped from end of line.",
+                           physical_line, edits)
+        return edits
 
 
 class trailing_blank_lines(Check):
@@ -285,14 +610,19 @@ class trailing_blank_lines(Check):
     """
     codes = ['W391']
 
+    def candidates(self, source, lines):
+        return [len(source) - len(lines[-1])]
+
     def check(self, physical_line, lines, line_number):
         if physical_line.strip() == '' and line_number == len(lines):
             return 0, "W391 blank line at end of file"
 
     def fix(self, checker, physical_line, lines, line_number):
-        fixed = ''
-        checker.report_fix("superfluous trailing blank line removed from end of file.", physical_line, fixed)
-        return fixed
+        edits = [(0, len(physical_line), '')]
+        checker.report_fix(
+            "superfluous trailing blank line removed from end of file.",
+            physical_line, edits)
+        return edits
 
 
 class missing_newline(Check):
@@ -301,14 +631,18 @@ class missing_newline(Check):
     """
     codes = ['W292']
 
+    def candidates(self, source, lines):
+        return [len(source) - len(lines[-1])]
+
     def check(self, physical_line):
         if physical_line.rstrip() == physical_line:
             return len(physical_line), "W292 no newline at end of file"
 
     def fix(self, checker, physical_line):
-        fixed = physical_line + "\n"
-        checker.report_fix("newline added to end of file.", physical_line, fixed)
-        return fixed
+        edits = [(len(physical_line), 0, '\n')]
+        checker.report_fix("newline added to end of file.",
+                           physical_line, edits)
+        return edits
 
 
 class maximum_line_length(Check):
@@ -323,15 +657,21 @@ class maximum_line_length(Check):
     length to 72 characters is recommended.
     """
     codes = ['E501']
+    max_line_length = None
+
+    def candidates(self, source, lines):
+        if self.max_line_length != MAX_LINE_LENGTH:
+            self.max_line_length = MAX_LINE_LENGTH
+            self.candidate_regex = re.compile(
+                r'^[^\n]{%d}' % (MAX_LINE_LENGTH + 1), re.MULTILINE)
+        return Check.candidates(self, source, lines)
 
     def check(self, physical_line):
         line = physical_line.rstrip()
         length = len(line)
-        if length > MAX_LINE_LENGTH:
+        if length > MAX_LINE_LENGTH and hasattr(line, 'decode'):
+            # Python 2: the line could contain multi-byte characters
             try:
-                # The line could contain multi-byte characters
-                if not hasattr(line, 'decode'):   # Python 3
-                    line = line.encode('latin-1')
                 length = len(line.decode('utf-8'))
             except UnicodeDecodeError:
                 pass
@@ -434,6 +774,7 @@ class extraneous_whitespace(Check):
     E203: if x == 4 : print x, y; x, y = y, x
     """
     codes = ['E201', 'E202', 'E203']
+    candidate_regex = LazyRegex(r'[\[({] | [\]}),;:]')
 
     def check(self, logical_line):
         line = logical_line
@@ -450,7 +791,13 @@ class extraneous_whitespace(Check):
                     return found, "E203 whitespace before '%s'" % char
 
     def fix(self, checker, logical_line):
-        checker.logical_line = EXTRANEOUS_WHITESPACE_REGEX.sub(lambda match: match.group().strip(), logical_line)
+        edits = []
+        for match in EXTRANEOUS_WHITESPACE_REGEX.finditer(logical_line):
+            if match.group().startswith(' '):
+                edits.append((match.start(), 1, ''))
+            else:
+                edits.append((match.end() - 1, 1, ''))
+        return edits
 
 
 class missing_whitespace(Check):
@@ -467,30 +814,26 @@ class missing_whitespace(Check):
     E231: foo(bar,baz)
     """
     codes = ['E231']
+    candidate_regex = LazyRegex(r'[,;:][^ \t]')
 
-    def check(self, logical_line):
-        line = logical_line
-        for index in range(len(line) - 1):
+    def check(self, logical_line, logical_candidates, token_buffer):
+        for index in self.find(logical_line, logical_candidates[self],
+                               token_buffer):
+            return index, ("E231 missing whitespace after '%s'" %
+                           logical_line[index])
+
+    def find(self, line, candidates, token_buffer):
+        for index in candidates:
             char = line[index]
-            if char in ',;:' and line[index + 1] not in WHITESPACE:
-                before = line[:index]
-                if char == ':' and before.count('[') > before.count(']'):
-                    continue  # Slice syntax, no space required
-                if char == ',' and line[index + 1] in ')]':
-                    continue  # Allow tuple/list with only one element: (3,)
-                return index, "E231 missing whitespace after '%s'" % char
+            if char == ':' and token_buffer.depth(index)[1] > 0:
+                continue  # Slice syntax, no space required
+            if char == ',' and line[index + 1] in ')]':
+                continue  # Allow tuple/list with only one element: (3,)
+            yield index
 
-    def fix(self, checker, logical_line):
-        line = logical_line
-        for index, char in reversed(list(enumerate(line[:-1]))):
-            if char in ',;:' and line[index + 1] not in WHITESPACE:
-                before = line[:index]
-                if char == ':' and before.count('[') > before.count(']'):
-                    continue  # Slice syntax, no space required
-                if char == ',' and line[index + 1] in ')]':
-                    continue  # Allow tuple with only one element: (3,)
-                line = line[:index + 1] + ' ' + line[index + 1:]
-        checker.logical_line = line
+    def fix(self, checker, logical_line, logical_candidates, token_buffer):
+        return [(index + 1, 0, ' ') for index in self.find(
+            logical_line, logical_candidates[self], token_buffer)]
 
 
 class indentation(Check):
@@ -542,24 +885,25 @@ class whitespace_before_parameters(Check):
     """
     codes = ['E211']
 
-    def check(self, logical_line, tokens):
-        prev_type = tokens[0][0]
-        prev_text = tokens[0][1]
-        prev_end = tokens[0][3]
-        for index in range(1, len(tokens)):
-            token_type, text, start, end, line = tokens[index]
-            if (token_type == tokenize.OP and
+    def check(self, logical_line, token_buffer):
+        if '(' not in logical_line and '[' not in logical_line:
+            return
+        types = token_buffer.types
+        texts = token_buffer.texts
+        starts = token_buffer.starts
+        ends = token_buffer.ends
+        for index in range(1, len(types)):
+            text = texts[index]
+            prev_text = texts[index - 1]
+            if (types[index] == tokenize.OP and
                 text in '([' and
-                start != prev_end and
-                (prev_type == tokenize.NAME or prev_text in '}])') and
+                starts[index] != ends[index - 1] and
+                (types[index - 1] == tokenize.NAME or prev_text in '}])') and
                 # Syntax "class A (B):" is allowed, but avoid it
-                (index < 2 or tokens[index - 2][1] != 'class') and
+                (index < 2 or texts[index - 2] != 'class') and
                 # Allow "return (a.foo for a in range(5))"
                 (not keyword.iskeyword(prev_text))):
-                return prev_end, "E211 whitespace before '%s'" % text
-            prev_type = token_type
-            prev_text = text
-            prev_end = end
+                return ends[index - 1], "E211 whitespace before '%s'" % text
 
 
 class whitespace_around_operator(Check):
@@ -576,6 +920,7 @@ class whitespace_around_operator(Check):
     E224: a = 4 +\t5
     """
     codes = ['E221', 'E222', 'E223', 'E224']
+    candidate_regex = LazyRegex(r'\t|  ')
 
     def check(self, logical_line):
         for match in WHITESPACE_AROUND_OPERATOR_REGEX.finditer(logical_line):
@@ -590,11 +935,13 @@ class whitespace_around_operator(Check):
                                 "E221 multiple spaces before operator")
 
     def fix(self, checker, logical_line):
-        for match in reversed(list(WHITESPACE_AROUND_OPERATOR_REGEX.finditer(logical_line))):
+        edits = []
+        for match in WHITESPACE_AROUND_OPERATOR_REGEX.finditer(logical_line):
             before, whitespace, after = match.groups()
             if before in OPERATORS or after in OPERATORS:
-                logical_line = logical_line[:match.start()] + before + ' ' + after + logical_line[match.end():]
-        checker.logical_line = logical_line
+                edits.append((match.end(1), match.start(3) - match.end(1),
+                              ' '))
+        return edits
 
 
 class missing_whitespace_around_operator(Check):
@@ -629,57 +976,21 @@ class missing_whitespace_around_operator(Check):
     """
     codes = ['E225']
 
-    def check(self, logical_line, tokens):
-        parens = 0
-        need_space = False
-        prev_type = tokenize.OP
-        prev_text = prev_end = None
-        for token_type, text, start, end, line in tokens:
-            if token_type in (tokenize.NL, tokenize.NEWLINE, tokenize.ERRORTOKEN):
-                # ERRORTOKEN is triggered by backticks in Python 3000
-                continue
-            if text in ('(', 'lambda'):
-                parens += 1
-            elif text == ')':
-                parens -= 1
-            if need_space:
-                if start != prev_end:
-                    need_space = False
-                elif text == '>' and prev_text == '<':
-                    # Tolerate the "<>" operator, even if running Python 3
-                    pass
-                else:
-                    return prev_end, "E225 missing whitespace around operator"
-            elif token_type == tokenize.OP and prev_end is not None:
-                if text == '=' and parens:
-                    # Allow keyword args or defaults: foo(bar=None).
-                    pass
-                elif text in BINARY_OPERATORS:
-                    need_space = True
-                elif text in UNARY_OPERATORS:
-                    # Allow unary operators: -123, -x, +1.
-                    # Allow argument unpacking: foo(*args, **kwargs).
-                    if prev_type == tokenize.OP:
-                        if prev_text in '}])':
-                            need_space = True
-                    elif prev_type == tokenize.NAME:
-                        if prev_text not in E225NOT_KEYWORDS:
-                            need_space = True
-                    else:
-                        need_space = True
-                if need_space and start == prev_end:
-                    return prev_end, "E225 missing whitespace around operator"
-            prev_type = token_type
-            prev_text = text
-            prev_end = end
+    def check(self, logical_line, token_buffer):
+        for position in self.find(token_buffer):
+            return position, "E225 missing whitespace around operator"
 
-    def fix(self, checker, logical_line, tokens):
+    def find(self, token_buffer):
+        """
+        Generate the start of each token which needs a space before it.
+        """
         parens = 0
         need_space = False
         prev_type = tokenize.OP
         prev_text = prev_end = None
-        space_insertions = []
-        for token_type, text, start, end, line in tokens:
+        for token_type, text, start, end in zip(
+                token_buffer.types, token_buffer.texts,
+                token_buffer.starts, token_buffer.ends):
             if token_type in (tokenize.NL, tokenize.NEWLINE, tokenize.ERRORTOKEN):
                 # ERRORTOKEN is triggered by backticks in Python 3000
                 continue
@@ -694,7 +1005,7 @@ class missing_whitespace_around_operator(Check):
                     # Tolerate the "<>" operator, even if running Python 3
                     pass
                 else:
-                    space_insertions.append(prev_end[1])
+                    yield start
                     need_space = False
             elif token_type == tokenize.OP and prev_end is not None:
                 if text == '=' and parens:
@@ -714,15 +1025,17 @@ class missing_whitespace_around_operator(Check):
                     else:
                         need_space = True
                 if need_space and start == prev_end:
-                    space_insertions.append(start[1])
+                    yield start
             prev_type = token_type
             prev_text = text
             prev_end = end
-        index_offset = len(checker.indent_level * (checker.indent_char or ''))
-        for index in reversed(space_insertions):
-            index -= index_offset
-            logical_line = logical_line[:index] + ' ' + logical_line[index:]
-        checker.logical_line = logical_line
+
+    def fix(self, checker, logical_line, token_buffer):
+        starts = token_buffer.starts
+        offsets = dict([(starts[index], offset) for index, offset in
+                        zip(token_buffer.indices, token_buffer.offsets)])
+        return [(offsets[position], 0, ' ')
+                for position in self.find(token_buffer)]
 
 
 class whitespace_around_comma(Check):
@@ -740,19 +1053,23 @@ class whitespace_around_comma(Check):
     E242: a = (1,\t2)
     """
     codes = ['E241', 'E242']
+    candidate_regex = LazyRegex(r'[,;:](?:  |\t)')
 
-    def check(self, logical_line):
+    def check(self, logical_line, logical_candidates):
         line = logical_line
+        found = logical_candidates[self]
         for separator in ',;:':
-            found = line.find(separator + '  ')
-            if found > -1:
-                return found + 1, "E241 multiple spaces after '%s'" % separator
-            found = line.find(separator + '\t')
-            if found > -1:
-                return found + 1, "E242 tab after '%s'" % separator
+            for offset in found:
+                if line[offset] == separator and line[offset + 1] == ' ':
+                    return (offset + 1,
+                            "E241 multiple spaces after '%s'" % separator)
+            for offset in found:
+                if line[offset] == separator:
+                    return offset + 1, "E242 tab after '%s'" % separator
 
-    def fix(self, checker, logical_line):
-        checker.logical_line = re.sub(r'[,;:][ \t]+(?!#)', lambda match: match.group().strip() + ' ', logical_line)
+    def fix(self, checker, logical_line, logical_candidates):
+        return [(match.start() + 1, match.end() - match.start() - 1, ' ')
+                for match in COMMA_WHITESPACE_REGEX.finditer(logical_line)]
 
 
 class whitespace_around_named_parameter_equals(Check):
@@ -771,32 +1088,23 @@ class whitespace_around_named_parameter_equals(Check):
     E251: return magic(r = real, i = imag)
     """
     codes = ['E251']
-
-    def check(self, logical_line):
-        parens = 0
-        for match in WHITESPACE_AROUND_NAMED_PARAMETER_REGEX.finditer(
-                logical_line):
-            text = match.group()
-            if parens and len(text) == 3:
+    candidate_regex = WHITESPACE_AROUND_NAMED_PARAMETER_REGEX
+
+    def check(self, logical_line, logical_candidates, token_buffer):
+        for offset in logical_candidates[self]:
+            # The depth before the '=', not before the match: the match
+            # may start on a closing parenthesis, as in "(a, b)= 1, 2".
+            equals = logical_line.index('=', offset)
+            if token_buffer.depth(equals)[0]:
                 issue = "E251 no spaces around keyword / parameter equals"
-                return match.start(), issue
-            if text == '(':
-                parens += 1
-            elif text == ')':
-                parens -= 1
+                return offset, issue
 
-    def fix(self, checker, logical_line):
-        parens = 0
-        matches = WHITESPACE_AROUND_NAMED_PARAMETER_REGEX.finditer(logical_line)
-        for match in reversed(list(matches)):
-            text = match.group()
-            if parens and len(text) == 3:
-                logical_line = logical_line[:match.start()] + text.strip() + logical_line[match.end():]
-            if text == ')':
-                parens += 1
-            elif text == '(':
-                parens -= 1
-        checker.logical_line = logical_line
+    def fix(self, checker, logical_line, logical_candidates, token_buffer):
+        return [(match.start(), 3, match.group().strip())
+                for match in WHITESPACE_AROUND_NAMED_PARAMETER_REGEX.finditer(
+                    logical_line)
+                if token_buffer.depth(match.start() +
+                                      match.group().index('='))[0]]
 
 
 class whitespace_before_inline_comment(Check):
@@ -815,9 +1123,14 @@ class whitespace_before_inline_comment(Check):
     """
     CODES = ['E261', 'E262']
 
-    def check(self, logical_line, tokens):
+    def check(self, logical_line, token_buffer):
+        types = token_buffer.types
+        if tokenize.COMMENT not in types:
+            return
         prev_end = (0, 0)
-        for token_type, text, start, end, line in tokens:
+        for token_type, text, start, end, line in zip(
+                types, token_buffer.texts, token_buffer.starts,
+                token_buffer.ends, token_buffer.lines):
             if token_type == tokenize.NL:
                 continue
             if token_type == tokenize.COMMENT:
@@ -847,6 +1160,7 @@ class imports_on_separate_lines(Check):
     Okay: import foo.bar.yourclass
     """
     codes = ['E401']
+    candidate_regex = LazyRegex(r'^import ')
 
     def check(self, logical_line):
         line = logical_line
@@ -882,19 +1196,25 @@ class compound_statements(Check):
     E702: do_one(); do_two(); do_three()
     """
     codes = ['E701', 'E702']
+    candidate_regex = LazyRegex(r'[:;]')
 
-    def check(self, logical_line):
+    def check(self, logical_line, logical_candidates, token_buffer):
         line = logical_line
-        found = line.find(':')
-        if -1 < found < len(line) - 1:
-            before = line[:found]
-            if (before.count('{') <= before.count('}') and  # {'a': 1} (dict)
-                before.count('[') <= before.count(']') and  # [1:2] (slice)
-                not re.search(r'\blambda\b', before)):      # lambda x: x
-                return found, "E701 multiple statements on one line (colon)"
-        found = line.find(';')
-        if -1 < found:
-            return found, "E702 multiple statements on one line (semicolon)"
+        found = logical_candidates[self]
+        for offset in found:
+            if line[offset] == ':':
+                if offset < len(line) - 1:
+                    parens, brackets, braces = token_buffer.depth(offset)
+                    if (braces <= 0 and    # {'a': 1} (dict)
+                        brackets <= 0 and  # [1:2] (slice)
+                        not re.search(r'\blambda\b', line[:offset])):
+                        return (offset,
+                                "E701 multiple statements on one line (colon)")
+                break
+        for offset in found:
+            if line[offset] == ';':
+                return (offset,
+                        "E702 multiple statements on one line (semicolon)")
 
 
 class python_3000_has_key(Check):
@@ -906,11 +1226,11 @@ class python_3000_has_key(Check):
         print d["b"]
     """
     codes = ['W601']
+    candidate_regex = LazyRegex(r'\.has_key\(')
 
-    def check(self, logical_line):
-        pos = logical_line.find('.has_key(')
-        if pos > -1:
-            return pos, "W601 .has_key() is deprecated, use 'in'"
+    def check(self, logical_line, logical_candidates):
+        return (logical_candidates[self][0],
+                "W601 .has_key() is deprecated, use 'in'")
 
 
 class python_3000_raise_comma(Check):
@@ -924,6 +1244,7 @@ class python_3000_raise_comma(Check):
     form will be removed in Python 3000.
     """
     codes = ['W602']
+    candidate_regex = LazyRegex(r'^raise\s+\w+\s*,')
 
     def check(self, logical_line):
         match = RAISE_COMMA_REGEX.match(logical_line)
@@ -931,7 +1252,12 @@ class python_3000_raise_comma(Check):
             return match.start(1), "W602 deprecated form of raising exception"
 
     def fix(self, checker, logical_line):
-        checker.logical_line = RAISE_COMMA_REGEX.sub(lambda match: u'raise %s(%s)' % match.groups(), logical_line)
+        edits = []
+        for match in RAISE_COMMA_REGEX.finditer(logical_line):
+            # Leave the arguments alone, for the edits of other checks
+            edits.append((match.end(1), match.start(2) - match.end(1), '('))
+            edits.append((match.end(2), 0, ')'))
+        return edits
 
 
 class python_3000_not_equal(Check):
@@ -941,11 +1267,10 @@ class python_3000_not_equal(Check):
     The older syntax is removed in Python 3000.
     """
     codes = ['W603']
+    candidate_regex = LazyRegex(r'<>')
 
-    def check(self, logical_line):
-        pos = logical_line.find('<>')
-        if pos > -1:
-            return pos, "W603 '<>' is deprecated, use '!='"
+    def check(self, logical_line, logical_candidates):
+        return logical_candidates[self][0], "W603 '<>' is deprecated, use '!='"
 
 
 class python_3000_backticks(Check):
@@ -954,11 +1279,11 @@ class python_3000_backticks(Check):
     Use repr() instead.
     """
     codes = ['W604']
+    candidate_regex = LazyRegex(r'`')
 
-    def check(self, logical_line):
-        pos = logical_line.find('`')
-        if pos > -1:
-            return pos, "W604 backticks are deprecated, use 'repr()'"
+    def check(self, logical_line, logical_candidates):
+        return (logical_candidates[self][0],
+                "W604 backticks are deprecated, use 'repr()'")
 
 
 ##############################################################################
@@ -970,12 +1295,133 @@ if '' == ''.encode():
     # Python 2: implicit encoding.
     def readlines(filename):
         return open(filename).readlines()
+
+    def decode_source(source):
+        return source
 else:
-    # Python 3: decode to latin-1.
-    # This function is lazy, it does not read the encoding declaration.
-    # XXX: use tokenize.detect_encoding()
+    # Python 3: decode according to the encoding declaration (PEP 263).
     def readlines(filename):
-        return open(filename, encoding='latin-1').readlines()
+        return list(read_source(filename))
+
+    def decode_source(source):
+        source = source[:]
+        try:
+            # Pure ASCII reads the same in any declared encoding
+            return source.decode('ascii')
+        except UnicodeDecodeError:
+            pass
+        from io import BytesIO
+        try:
+            encoding = tokenize.detect_encoding(BytesIO(source).readline)[0]
+            return source.decode(encoding)
+        except (SyntaxError, LookupError, UnicodeDecodeError):
+            return source.decode('latin-1')
+
+
+def read_source(filename, use_mmap=True):
+    """
+    Read the lines of a source file, as SourceLines.
+
+    Large files are memory-mapped instead of read, unless use_mmap is
+    false, e.g. because they are about to be fixed.
+    """
+    stream = open(filename, 'rb')
+    try:
+        size = os.fstat(stream.fileno()).st_size
+        if size >= MMAP_THRESHOLD and use_mmap:
+            import mmap
+            source = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            source = stream.read()
+    finally:
+        stream.close()
+    lines = SourceLines(decode_source(source))
+    if lines.source is not source and hasattr(source, 'close'):
+        source.close()  # Python 3 decoded a copy
+    return lines
+
+
+class SourceLines(object):
+    r"""
+    The physical lines of a source file, sliced on demand from its source.
+
+    starts holds the offset where each line starts, followed by the length
+    of the source.  Lines support len(), iteration, indexing, slicing and
+    +, like a list of lines; slices and sums are lists.
+
+    >>> lines = SourceLines('a = 1\nb = 2')
+    >>> len(lines), lines[0], lines[-1], lines.line_number(7)
+    (2, 'a = 1\n', 'b = 2', 2)
+    >>> lines[:1] + lines[1:]
+    ['a = 1\n', 'b = 2']
+    """
+    __slots__ = ('source', 'starts')
+
+    def __init__(self, source):
+        self.source = source
+        self.starts = starts = array('l', [0])
+        starts.extend([match.end() for match in
+                       NEWLINE_REGEX.finditer(source)])
+        if starts[-1] != len(source):
+            starts.append(len(source))
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self.starts) - 1
+        return self.source[self.starts[index]:self.starts[index + 1]]
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __iter__(self):
+        for index in range(len(self.starts) - 1):
+            yield self[index]
+
+    def line_number(self, offset):
+        """
+        Return the number of the line at this offset of the source.
+        """
+        return bisect_right(self.starts, offset)
+
+    def close(self):
+        """
+        Close the memory map of the source, if read_source() made one.
+        """
+        close = getattr(self.source, 'close', None)
+        if close is not None:
+            close()
+
+
+def write_atomic(filename, data):
+    """
+    Write data to a temporary file and rename it to filename, so that
+    readers never see a partly written file.  The permissions of an
+    existing file are kept.
+    """
+    temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    stream = open(temp_filename, 'wb')
+    try:
+        stream.write(data)
+    finally:
+        stream.close()
+    try:
+        os.chmod(temp_filename, stat.S_IMODE(os.stat(filename).st_mode))
+    except OSError:
+        pass
+    try:
+        os.rename(temp_filename, filename)
+    except OSError:
+        # Windows does not replace an existing file
+        os.remove(filename)
+        os.rename(temp_filename, filename)
 
 
 def expand_indent(line):
@@ -1005,6 +1451,70 @@ def expand_indent(line):
     return result
 
 
+def apply_edits(line, edits):
+    r"""
+    Apply a list of edits (offset, length, text) to a line in one pass.
+
+    The edits are applied in order of offset.  An edit which overlaps an
+    edit before it is dropped, so is an insertion at the offset of another
+    insertion: the first edit in the list wins.
+
+    >>> apply_edits('a=b ,c', [(1, 0, ' '), (2, 0, ' '), (3, 1, '')])
+    'a = b,c'
+    >>> apply_edits('a  =b', [(1, 2, ' '), (2, 1, ''), (4, 0, ' ')])
+    'a = b'
+    """
+    pieces = []
+    position = 0
+    inserted = -1
+    for offset, length, text in sorted(edits, key=lambda edit: edit[0]):
+        if offset < position or (offset == inserted and not length):
+            continue
+        pieces.append(line[position:offset])
+        pieces.append(text)
+        position = offset + length
+        if not length:
+            inserted = offset
+    pieces.append(line[position:])
+    return ''.join(pieces)
+
+
+def merge_edits(groups):
+    r"""
+    Return the edits of the groups, each the edits of one fix(), without
+    the groups which conflict with a group kept before: a fix is applied
+    completely or not at all.  Two edits conflict if they overlap, or if
+    one is an insertion which touches the other, e.g. an insertion at
+    either end of a replacement.
+
+    The groups which replace more characters are kept first, since they
+    usually make the fixes inside them unnecessary: W602 replaces the
+    comma of "raise E , 'x'" and the spaces around it, which E203 and
+    E231 would fix.  Otherwise the first group in the list wins.
+
+    >>> merge_edits([[(11, 1, '')], [(11, 3, '('), (17, 0, ')')]])
+    [(11, 3, '('), (17, 0, ')')]
+    >>> merge_edits([[(1, 0, ' '), (2, 0, ' ')], [(4, 1, '')]])
+    [(4, 1, ''), (1, 0, ' '), (2, 0, ' ')]
+    >>> merge_edits([[(2, 0, ' ')], [(2, 0, '  ')]])
+    [(2, 0, ' ')]
+    >>> merge_edits([[(10, 3, '=1')], [(13, 1, '')], [(10, 0, ' ')]])
+    [(10, 3, '=1'), (13, 1, '')]
+    """
+    edits = []
+    for group in sorted(groups, key=lambda group: -sum(
+            [length for offset, length, text in group])):
+        for offset, length, text in group:
+            if [start for start, size, replacement in edits
+                if offset < start + size and start < offset + length or
+                (not (length and size) and
+                 offset <= start + size and start <= offset + length)]:
+                break
+        else:
+            edits.extend(group)
+    return edits
+
+
 def mute_string(text):
     """
     Replace contents with 'xxx' to prevent syntax matching.
@@ -1030,6 +1540,16 @@ def mute_string(text):
     return text[:start] + 'x' * (end - start) + text[end:]
 
 
+def command_line_options(options=None):
+    """
+    Return options, or the options of the command line if it is None,
+    see process_options().
+    """
+    if options is None:
+        return globals()['options']
+    return options
+
+
 def message(text):
     """Print a message."""
     # print >> sys.stderr, options.prog + ': ' + text
@@ -1042,34 +1562,149 @@ def message(text):
 ##############################################################################
 
 
+class TokenBuffer(object):
+    """
+    The tokens of a logical line, stored in parallel tuples: token types,
+    texts, start and end positions, and physical lines.  The tuples are
+    made by zip(), which is cheaper than building arrays.
+
+    The offsets and indices arrays map the logical line to the tokens:
+    the token at indices[i] starts at offsets[i] in the logical line.
+    The brackets are indexed on the first call to depth(), so that the
+    checks share this work, and it is not done for most lines.
+    """
+
+    __slots__ = ('types', 'texts', 'starts', 'ends', 'lines',
+                 'offsets', 'indices', 'brackets', 'depths')
+
+    def __init__(self, tokens):
+        (self.types, self.texts, self.starts, self.ends,
+         self.lines) = zip(*tokens) or [()] * 5
+        self.offsets = array('i')
+        self.indices = array('i')
+        self.brackets = self.depths = None
+
+    def __len__(self):
+        return len(self.types)
+
+    def position(self, offset):
+        """
+        Return the position in offsets and indices of the token which
+        covers offset in the logical line.
+        """
+        return bisect_right(self.offsets, offset) - 1
+
+    def depth(self, offset):
+        """
+        Return the numbers of parentheses, brackets and braces which are
+        opened before offset in the logical line, and not closed.
+        """
+        if self.depths is None:
+            self.index_brackets()
+        return self.depths[bisect_left(self.brackets, offset)]
+
+    def index_brackets(self):
+        """
+        Store the offsets of the brackets in the logical line, and the
+        depths after each of them, starting with (0, 0, 0).
+
+        Comments are part of the logical line, and the brackets in them
+        are counted too, as if the text before an offset was counted.
+        """
+        types = self.types
+        texts = self.texts
+        self.brackets = brackets = array('i')
+        self.depths = depths = [(0, 0, 0)]
+        parens = squares = braces = 0
+        for index, offset in zip(self.indices, self.offsets):
+            text = texts[index]
+            if types[index] == tokenize.COMMENT:
+                found = [(offset + column, char)
+                         for column, char in enumerate(text)
+                         if char in BRACKETS]
+            elif text in BRACKETS and types[index] == tokenize.OP:
+                found = [(offset, text)]
+            else:
+                continue
+            for start, char in found:
+                if char == '(':
+                    parens += 1
+                elif char == ')':
+                    parens -= 1
+                elif char == '[':
+                    squares += 1
+                elif char == ']':
+                    squares -= 1
+                elif char == '{':
+                    braces += 1
+                else:
+                    braces -= 1
+                brackets.append(start)
+                depths.append((parens, squares, braces))
+
+
 class Checker(object):
     """
     Load a Python source file, tokenize it, check coding style.
-    """
 
-    def __init__(self, filename, lines=None):
+    The state lives in slots.  Call reset() to check another file with
+    the same instance.
+    """
+
+    __slots__ = ('options', 'filename', 'lines', 'fixed_physical_lines',
+                 'resync', 'recorded_errors', 'selected_lines', 'write_filename',
+                 'writer', 'expected', 'line_offset', 'file_errors',
+                 'line_number', 'physical_line', 'logical_line',
+                 'previous_logical', 'indent_char', 'indent_level',
+                 'previous_indent_level', 'blank_lines',
+                 'blank_lines_before_comment', 'comment', 'tokens',
+                 'token_buffer', 'muted_strings', 'physical_candidates',
+                 'physical_default', 'logical_candidates')
+
+    def __init__(self, filename, lines=None, options=None):
+        options = command_line_options(options)
+        self.options = options
+        self.writer = None
+        self.resync = None
+        self.logical_candidates = {}
+        self.lines = None
+        self.reset(filename, lines)
+
+    def reset(self, filename, lines=None):
+        """
+        Load another Python source file.
+        """
+        options = self.options
+        if isinstance(self.lines, SourceLines) and self.lines is not lines:
+            self.lines.close()
         self.filename = filename
         if filename is None:
             self.filename = 'stdin'
             self.lines = lines or []
         elif lines is None:
-            self.lines = readlines(filename)
+            self.lines = read_source(filename, not options.fix)
         else:
             self.lines = lines
         self.fixed_physical_lines = []
+        self.recorded_errors = None
+        self.selected_lines = None
+        if options.diff_lines is not None:
+            self.selected_lines = options.diff_lines.get(filename, ())
         options.counters['physical lines'] += len(self.lines)
         self.write_filename = None
-        if options.fix:
+        if options.fix and filename is not None:
             if options.inplace:
                 self.write_filename = filename
             else:
                 self.write_filename = "fixed_" + filename
 
-    def report_fix(self, msg, old, new):
+    def report_fix(self, msg, old, edits):
+        options = self.options
         if not options.quiet:
+            new = apply_edits(old, edits).replace('\n', '\\n')
             old = old.replace('\n', '\\n')
-            new = new.replace('\n', '\\n')
-            print " - pep8 fix: %s\n\t-%s\n\t+%s" % (msg, old, new)
+            options.reporter.message(" - pep8 fix: %s\n\t-%s\n\t+%s" %
+                                     (msg, old, new))
 
     def readline(self):
         """
@@ -1091,37 +1726,94 @@ class Checker(object):
             return line
         return line
 
+    def find_candidates(self):
+        """
+        Find the physical lines where each check may find an error, with
+        a few regular expression searches over the whole file.
+
+        After this, check_physical() runs a check on a line only if the
+        line is one of its candidates.
+        """
+        options = self.options
+        self.physical_candidates = {}
+        self.physical_default = []
+        if not self.lines:
+            return
+        lines = self.lines
+        if not isinstance(lines, SourceLines):
+            lines = SourceLines(''.join(lines))
+            if len(lines) != len(self.lines):
+                # Lines not split at newlines, check every line
+                self.physical_candidates = None
+                return
+        source = lines.source
+        plan = options.physical_plan
+        profile = options.check_profile
+        default = set()
+        found = []
+        for index, entry in enumerate(plan):
+            scan = entry[1].candidates
+            if profile is not None:
+                scan = profile_scan(entry[0] + '.candidates', scan, profile)
+            candidates = scan(source, lines)
+            if candidates is None:
+                default.add(index)
+                self.physical_default.append(entry)
+            else:
+                found.extend([(offset, index) for offset in candidates])
+        indices = {}
+        line_number = lines.line_number
+        for offset, index in found:
+            indices.setdefault(line_number(offset), set(default)).add(index)
+        for line_number, line_indices in indices.items():
+            # Keep the order of options.physical_plan
+            self.physical_candidates[line_number] = [
+                plan[index] for index in sorted(line_indices)]
+
     def check_physical(self, line):
         """
         Run all physical checks on a raw input line.
         """
+        options = self.options
         self.physical_line = line
         if self.indent_char is None and len(line) and line[0] in ' \t':
             self.indent_char = line[0]
-        for name, check, argument_names in options.physical_checks:
-            args = [getattr(self, argname) for argname in argument_names]
-            result = check.check(*args)
+        if self.physical_candidates is None:
+            plan = options.physical_plan
+        else:
+            plan = self.physical_candidates.get(self.line_number,
+                                                self.physical_default)
+        edits = []
+        for name, check, argument_names, run in plan:
+            result = run(self)
             if result is not None:
                 offset, text = result
                 self.report_error(self.line_number, offset, text, check)
                 if options.fix and hasattr(check, 'fix'):
                     code = text[:4]
-                    if not ignore_code(code):
-                        self.physical_line = check.fix(self, *args)
-        self.fixed_physical_lines.append(self.physical_line)
+                    if not ignore_code(code, options):
+                        args = [getattr(self, argname)
+                                for argname in argument_names]
+                        edits.append(check.fix(self, *args) or ())
+        if options.fix:
+            self.fixed_physical_lines.append(
+                apply_edits(line, merge_edits(edits)))
 
     def build_tokens_line(self):
         """
         Build a logical line from tokens.
         """
-        self.mapping = []
+        buffer = self.token_buffer = TokenBuffer(self.tokens)
+        add_offset = buffer.offsets.append
+        add_index = buffer.indices.append
         logical = []
         length = 0
         previous = None
-        for token in self.tokens:
-            token_type, text = token[0:2]
+        for index, token in enumerate(self.tokens):
+            token_type = token[0]
             if token_type in SKIP_TOKENS:
                 continue
+            text = token[1]
             if token_type == tokenize.STRING:
                 self.muted_strings.append(text)
                 text = mute_string(text)
@@ -1138,7 +1830,8 @@ class Checker(object):
                     fill = self.lines[end_line - 1][end:start]
                     logical.append(fill)
                     length += len(fill)
-            self.mapping.append((length, token))
+            add_offset(length)
+            add_index(index)
             logical.append(text)
             length += len(text)
             previous = token
@@ -1149,45 +1842,50 @@ class Checker(object):
         """
         Build a line from tokens and run all logical checks on it.
         """
+        options = self.options
         options.counters['logical lines'] += 1
         self.muted_strings = []
         self.build_tokens_line()
-        physical_line_numbers = set()
-        for mapping_line in self.mapping:
-            physical_line_numbers.add(mapping_line[1][2][0] - 1)
-            physical_line_numbers.add(mapping_line[1][3][0] - 1)
-        physical_line_numbers = list(sorted(physical_line_numbers))
-        first_line = self.lines[self.mapping[0][1][2][0] - 1]
-        indent = first_line[:self.mapping[0][1][2][1]]
+        buffer = self.token_buffer
+        starts = buffer.starts
+        start_row, start_col = starts[buffer.indices[0]]
+        first_line = self.lines[start_row - 1]
+        indent = first_line[:start_col]
         self.previous_indent_level = self.indent_level
         self.indent_level = expand_indent(indent)
         if options.verbose >= 2:
             print(self.logical_line[:80].rstrip())
-        for name, check, argument_names in options.logical_checks:
+        self.logical_candidates = options.logical_scanner(self.logical_line)
+        edits = []
+        for name, check, argument_names, run in options.logical_plan:
             if options.verbose >= 4:
                 print('   ' + name)
-            args = [getattr(self, argname) for argname in argument_names]
-            result = check.check(*args)
+            result = run(self)
             if result is not None:
                 offset, text = result
                 if isinstance(offset, tuple):
                     original_number, original_offset = offset
                 else:
-                    for token_offset, token in self.mapping:
-                        if offset >= token_offset:
-                            original_number = token[2][0]
-                            original_offset = (token[2][1]
-                                               + offset - token_offset)
+                    position = buffer.position(offset)
+                    original_number, start_col = starts[
+                        buffer.indices[position]]
+                    original_offset = (start_col + offset -
+                                       buffer.offsets[position])
                 self.report_error(original_number, original_offset,
                                   text, check)
                 if options.fix and hasattr(check, 'fix'):
                     code = text[:4]
-                    if not ignore_code(code):
-                        result = check.fix(self, *args)
-                        if result is not None:
-                            self.logical_line = result
+                    if not ignore_code(code, options):
+                        args = [getattr(self, argname)
+                                for argname in argument_names]
+                        edits.append(check.fix(self, *args) or ())
         if options.fix:
-            if len(physical_line_numbers) == 1:
+            self.logical_line = apply_edits(self.logical_line,
+                                            merge_edits(edits))
+            # The tokens are in order: the first starts on the first row
+            first_row = start_row - 1
+            last_row = buffer.ends[buffer.indices[-1]][0] - 1
+            if first_row == last_row:
                 str_index = 0
                 for muted_string in self.muted_strings:
                     str_modifiers = ''
@@ -1216,7 +1914,7 @@ class Checker(object):
                 # can't easily fix logical lines that are split over multiple physical lines
                 # because putting the whitespace back how it was isn't easy :(
                 self.writer.write('\n' * self.blank_lines)
-                for line_number in range(physical_line_numbers[0], physical_line_numbers[-1] + 1):
+                for line_number in range(first_row, last_row + 1):
                     self.writer.write(self.fixed_physical_lines[line_number])
         self.previous_logical = self.logical_line
 
@@ -1224,6 +1922,7 @@ class Checker(object):
         """
         Run all checks on the input file.
         """
+        options = self.options
         self.comment = None
         self.expected = expected or ()
         self.line_offset = line_offset
@@ -1235,9 +1934,37 @@ class Checker(object):
         self.blank_lines = 0
         self.blank_lines_before_comment = 0
         self.tokens = []
-        self.writer = StringIO()
+        self.physical_candidates = None
+        if not options.fix:
+            self.find_candidates()
+        if options.fix:
+            if self.writer is None:
+                from StringIO import StringIO
+                self.writer = StringIO()
+            else:
+                self.writer.seek(0)
+                self.writer.truncate()
+        try:
+            self.check_tokens(
+                tokenize.generate_tokens(self.readline_check_physical))
+            if self.write_filename:
+                self.write_fixed()
+        finally:
+            # Report the errors found before tokenize raised, if it did
+            options.reporter.end_file()
+        return self.file_errors
+
+    def check_tokens(self, tokens):
+        """
+        Run the logical checks on tokens, as they are generated.
+
+        If self.resync is set, it is called after each logical line, where
+        the tokenizer could start again; checking stops when it returns
+        true.
+        """
+        options = self.options
         parens = 0
-        for token in tokenize.generate_tokens(self.readline_check_physical):
+        for token in tokens:
             if options.verbose >= 3:
                 if token[2][0] == token[3][0]:
                     pos = '[%s:%s]' % (token[2][1] or '', token[3][1])
@@ -1256,6 +1983,8 @@ class Checker(object):
                 self.blank_lines = 0
                 self.blank_lines_before_comment = 0
                 self.tokens = []
+                if self.resync is not None and self.resync():
+                    return
             if token_type == tokenize.NL and not parens:
                 if self.comment and options.fix:
                     self.writer.write('\n' * self.blank_lines_before_comment)
@@ -1281,22 +2010,44 @@ class Checker(object):
                 if len(self.tokens) == 1:
                     # comment is on a line by itself
                     self.comment = source_line.rstrip()
-        if self.write_filename:
-            write_file = open(self.write_filename, 'w')
-            write_file.write(self.writer.getvalue())
-            write_file.close()
 
-        return self.file_errors
+    def write_fixed(self):
+        """
+        Write the fixed source if it differs from the input, unless the
+        target already contains it.  With --diff-output, print the fixes
+        as a unified diff instead.
+        """
+        fixed = self.writer.getvalue()
+        original = ''.join(self.lines)
+        if fixed == original:
+            return
+        if self.options.diff_output:
+            print_diff(self.filename, original, fixed)
+            return
+        if (self.write_filename != self.filename and
+                os.path.exists(self.write_filename) and
+                open(self.write_filename, 'rb').read() == fixed):
+            return
+        write_atomic(self.write_filename, fixed)
 
     def report_error(self, line_number, offset, text, check):
         """
         Report an error, according to options.
         """
+        options = self.options
         code = text[:4]
-        if ignore_code(code):
+        if ignore_code(code, options):
+            return
+        if self.recorded_errors is not None:
+            # Counting and output are done later by replay_errors()
+            self.recorded_errors.append((line_number, offset, text,
+                                         check.__class__.__name__))
+            return
+        if (self.selected_lines is not None and
+            line_number not in self.selected_lines):
             return
         if options.quiet == 1 and not self.file_errors:
-            message(self.filename)
+            options.reporter.message(self.filename)
         if code in options.counters:
             options.counters[code] += 1
         else:
@@ -1307,77 +2058,998 @@ class Checker(object):
             return
         self.file_errors += 1
         if options.counters[code] == 1 or options.repeat:
-            message("%s:%s:%d: %s" %
-                    (self.filename, self.line_offset + line_number,
-                     offset + 1, text))
-            if options.show_source:
-                line = self.lines[line_number - 1]
-                message(line.rstrip())
-                message(' ' * offset + '^')
-            if options.show_pep8:
-                message(check.__doc__.lstrip('\n').rstrip())
+            options.reporter.error(self, line_number, offset, text, check)
+
+    def replay_errors(self, errors, expected=(), line_offset=0):
+        """
+        Report errors which were recorded by an earlier run, e.g. in a
+        worker process or in the result cache.
+        """
+        options = self.options
+        self.expected = expected
+        self.line_offset = line_offset
+        self.file_errors = 0
+        for line_number, offset, text, name in errors:
+            self.report_error(line_number, offset, text,
+                              options.checks_by_name[name])
+        options.reporter.end_file()
+        return self.file_errors
 
 
-def input_file(filename):
+class ResultCache(object):
     """
-    Run all checks on a Python source file.
+    Store the errors found in each file, keyed by a hash of the file
+    content and of everything else which changes the result: the version,
+    the enabled checks, select, ignore and MAX_LINE_LENGTH.
+
+    An index of (mtime, size, content hash) per filename avoids hashing
+    files which did not change.  Cache entries which were not used for a
+    long time are removed when the cache grows beyond max_size bytes.
     """
-    if options.verbose:
-        message('checking ' + filename)
-    Checker(filename).check_all()
 
+    def __init__(self, directory, max_size, options):
+        import marshal
+        try:
+            from hashlib import sha1
+        except ImportError:
+            from sha import new as sha1
+        self.sha1 = sha1
+        self.load = marshal.load
+        self.dumps = marshal.dumps
+        self.directory = directory
+        self.max_size = max_size
+        self.index_filename = os.path.join(directory, 'index')
+        self.stored = 0
+        parts = [__version__, sys.version, str(MAX_LINE_LENGTH),
+                 'select'] + options.select + ['ignore'] + options.ignore
+        for name, check, argument_names in (options.physical_checks +
+                                            options.logical_checks):
+            parts.append(name)
+        self.fingerprint = self.sha1('\0'.join(parts).encode()).hexdigest()
+        try:
+            self.index = self.read(self.index_filename)
+        except (IOError, EOFError, ValueError, TypeError):
+            self.index = {}
 
-def input_dir(dirname, runner=None):
-    """
-    Check all Python source files in this directory and all subdirectories.
-    """
-    dirname = dirname.rstrip('/')
-    if excluded(dirname):
-        return
-    if runner is None:
-        runner = input_file
-    for root, dirs, files in os.walk(dirname):
-        if options.verbose:
-            message('directory ' + root)
-        options.counters['directories'] += 1
+    def read(self, filename):
+        stream = open(filename, 'rb')
+        try:
+            return self.load(stream)
+        finally:
+            stream.close()
+
+    def write(self, filename, value):
+        """
+        Write atomically, in case another process reads the same file.
+        """
+        write_atomic(filename, self.dumps(value))
+
+    def entry_filename(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def lookup(self, filename):
+        """
+        Return (key, result).  The result is None if the file is not
+        in the cache.
+        """
+        stat = os.stat(filename)
+        stamp = (stat.st_mtime, stat.st_size)
+        path = os.path.abspath(filename)
+        entry = self.index.get(path)
+        if entry is not None and entry[:2] == stamp:
+            digest = entry[2]
+        else:
+            stream = open(filename, 'rb')
+            try:
+                digest = self.sha1(stream.read()).hexdigest()
+            finally:
+                stream.close()
+            self.index[path] = stamp + (digest,)
+        key = self.sha1((self.fingerprint + digest).encode()).hexdigest()
+        entry_filename = self.entry_filename(key)
+        try:
+            result = self.read(entry_filename)
+            # Remember when the entry was used, for the eviction
+            os.utime(entry_filename, None)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            result = None
+        return key, result
+
+    def store(self, key, result):
+        entry_filename = self.entry_filename(key)
+        subdir = os.path.dirname(entry_filename)
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        self.write(entry_filename, result)
+        self.stored += 1
+
+    def save(self):
+        """
+        Write the index and remove least recently used cache entries.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.write(self.index_filename, self.index)
+        if self.stored:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for subdir in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                entry_filename = os.path.join(subdir, name)
+                stat = os.stat(entry_filename)
+                entries.append((stat.st_mtime, stat.st_size, entry_filename))
+                total_size += stat.st_size
+        entries.sort()
+        for mtime, size, entry_filename in entries:
+            if total_size <= self.max_size:
+                break
+            os.remove(entry_filename)
+            total_size -= size
+
+
+class TextReporter(object):
+    """
+    Report errors as text, one line per error, followed by the source
+    line with --show-source and the text of PEP 8 with --show-pep8.
+
+    The output is buffered and written at the end of each file, or every
+    REPORT_BUFFER_SIZE lines, except in verbose mode where it is mixed
+    with the debugging output.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.buffer = []
+        self.buffer_size = REPORT_BUFFER_SIZE
+        if options.verbose:
+            self.buffer_size = 1
+
+    def message(self, text):
+        self.write(text + '\n')
+
+    def write(self, text):
+        self.buffer.append(text)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def error(self, checker, line_number, offset, text, check):
+        self.message("%s:%s:%d: %s" % (checker.filename,
+                                       checker.line_offset + line_number,
+                                       offset + 1, text))
+        if self.options.show_source:
+            line = checker.lines[line_number - 1]
+            self.message(line.rstrip())
+            self.message(' ' * offset + '^')
+        if self.options.show_pep8:
+            self.message(check.__doc__.lstrip('\n').rstrip())
+
+    def end_file(self):
+        self.flush()
+
+    def end(self):
+        self.flush()
+
+    def flush(self):
+        if self.buffer:
+            sys.stdout.write(''.join(self.buffer))
+            del self.buffer[:]
+
+
+class JSONLinesReporter(TextReporter):
+    """
+    Report each error as a JSON object on a line of its own.
+    """
+
+    def __init__(self, options):
+        import json
+        TextReporter.__init__(self, options)
+        self.dumps = json.dumps
+
+    def message(self, text):
+        pass
+
+    def error(self, checker, line_number, offset, text, check):
+        self.write(self.dumps({
+            'filename': checker.filename,
+            'line': checker.line_offset + line_number,
+            'column': offset + 1,
+            'code': text[:4],
+            'message': text[5:],
+            'check': check.__class__.__name__}) + '\n')
+
+
+class SarifReporter(TextReporter):
+    """
+    Report all errors as one SARIF 2.1.0 log, written at the end.
+    """
+
+    def __init__(self, options):
+        TextReporter.__init__(self, options)
+        self.results = []
+        self.rules = {}
+
+    def message(self, text):
+        pass
+
+    def error(self, checker, line_number, offset, text, check):
+        code = text[:4]
+        if code not in self.rules:
+            self.rules[code] = {'id': code,
+                                'name': check.__class__.__name__,
+                                'shortDescription': {'text': text[5:]}}
+        self.results.append({
+            'ruleId': code,
+            'level': code.startswith('W') and 'warning' or 'error',
+            'message': {'text': text[5:]},
+            'locations': [{'physicalLocation': {
+                'artifactLocation': {
+                    'uri': checker.filename.replace(os.sep, '/')},
+                'region': {'startLine': checker.line_offset + line_number,
+                           'startColumn': offset + 1}}}]})
+
+    def end_file(self):
+        pass
+
+    def end(self):
+        import json
+        driver = {'name': 'pep8', 'version': __version__,
+                  'informationUri': 'http://github.com/jcrocholl/pep8',
+                  'rules': [self.rules[code] for code in sorted(self.rules)]}
+        sys.stdout.write(json.dumps({
+            'version': '2.1.0',
+            '$schema': 'https://json.schemastore.org/sarif-2.1.0.json',
+            'runs': [{'tool': {'driver': driver},
+                      'results': self.results}]}) + '\n')
+
+
+REPORTERS = {
+    'default': TextReporter,
+    'jsonl': JSONLinesReporter,
+    'sarif': SarifReporter,
+}
+
+
+class StyleGuide(object):
+    """
+    Check Python source code with options of its own, for use as a
+    library, without the module-level options of the command line.
+
+    The settings have the names of the long command line options, e.g.
+    StyleGuide(select='E2,W6', exclude=['build']), and arglist can give
+    command line options too.  A StyleGuide does not change once built,
+    so check_source() and check_files() can be called from several
+    threads at once.  They return errors as tuples (filename, line number,
+    column, code, message), reporting every occurrence of each error.
+
+    >>> StyleGuide(select='E2').check_source('a=1\\n')
+    [('stdin', 1, 2, 'E225', 'missing whitespace around operator')]
+    """
+
+    def __init__(self, arglist=None, **settings):
+        options = get_parser().parse_args(list(arglist or []))[0]
+        for name, value in settings.items():
+            if not hasattr(options, name):
+                raise TypeError("unknown setting '%s'" % name)
+            setattr(options, name, value)
+        self.options = init_options(options)
+
+    def run_options(self):
+        """
+        Copy the options, with counters and a reporter for a single call.
+        """
+        import copy
+        options = copy.copy(self.options)
+        options.counters = dict.fromkeys(BENCHMARK_KEYS, 0)
+        options.messages = {}
+        options.reporter = REPORTERS[options.format](options)
+        return options
+
+    def check_source(self, source, filename='stdin'):
+        """
+        Check Python source code given as a string.
+        """
+        checker = Checker(None, SourceLines(source), self.run_options())
+        checker.filename = filename
+        return self.check(checker)
+
+    def fix_source(self, source):
+        r"""
+        Return Python source code given as a string, with the fixes of
+        --fix applied.  Each fix is applied completely or not at all, so
+        some fixes may need another call.
+
+        >>> fix_source = StyleGuide().fix_source
+        >>> fix_source("raise Error , 'x'\n")
+        "raise Error('x')\n"
+        >>> fix_source("raise Error,'x'\n")
+        "raise Error('x')\n"
+        >>> fix_source("raise Error ,'x', 1\n")
+        "raise Error('x', 1)\n"
+        >>> fix_source("foo(  bar =1 , baz=[1:2]  )\n")
+        'foo( bar=1, baz=[1:2] )\n'
+        >>> fix_source("(a, b)= 1, 2\n")
+        '(a, b) = 1, 2\n'
+        """
+        options = self.run_options()
+        options.fix = True
+        options.quiet = 2
+        checker = Checker(None, SourceLines(source), options)
+        checker.recorded_errors = []
+        checker.check_all()
+        return checker.writer.getvalue()
+
+    def check_files(self, paths):
+        """
+        Check Python source files, and the directories given in paths.
+        """
+        options = self.run_options()
+        errors = []
+        for filename in input_paths(paths, options):
+            errors.extend(self.check(Checker(filename, options=options)))
+        return errors
+
+    def check(self, checker):
+        checker.recorded_errors = []
+        checker.check_all()
+        return [(checker.filename, line_number, offset + 1,
+                 text[:4], text[5:])
+                for line_number, offset, text, name in checker.recorded_errors]
+
+
+class Document(object):
+    r"""
+    Python source code kept in memory, e.g. the buffer of an editor, and
+    checked again after each edit, as little as possible.
+
+    The errors are kept in segments, which start after each logical line:
+    the tokenizer can start again there, with the state of the checker
+    and the indentation of the enclosing blocks saved at that point.  An
+    edit is checked from the last segment before it, until a segment
+    starts with the same row and state as before the edit.  The errors
+    after that are reused.
+
+    >>> document = Document(StyleGuide(), 'a = 1\nb=2\nc = 3\n')
+    >>> document.errors()
+    [('stdin', 2, 2, 'E225', 'missing whitespace around operator')]
+    >>> document.edit(2, 3, 'b = 2\n')
+    []
+    """
+
+    def __init__(self, style_guide, source, filename='stdin'):
+        self.lines = source.splitlines(True)
+        self.checker = Checker(None, self.lines, style_guide.run_options())
+        self.checker.filename = filename
+        # [row, state, errors], where the checker has read row lines
+        self.segments = []
+        self.check_from(0, (None, 0, '', None, ()))
+
+    def edit(self, start, end, text):
+        """
+        Replace the lines from start up to end (excluded) with the lines
+        of text, and return all the errors.  Lines are numbered from 1,
+        and start == end inserts text before line start.
+        """
+        lines = text.splitlines(True)
+        if lines and not lines[-1].endswith('\n') and end <= len(self.lines):
+            lines[-1] += '\n'
+        self.lines[start - 1:end - 1] = lines
+        rows = [segment[0] for segment in self.segments]
+        index = bisect_right(rows, start - 1) - 1
+        row, state = self.segments[index][:2]
+        old = self.segments[index + 1:]
+        del self.segments[index:]
+        self.check_from(row, state, start - 1 + len(lines), old,
+                        len(lines) - (end - start))
+        return self.errors()
+
+    def errors(self):
+        """
+        Return the errors as tuples (filename, line number, column, code,
+        message), like StyleGuide.check_source().
+        """
+        filename = self.checker.filename
+        return [(filename, line_number, offset + 1, text[:4], text[5:])
+                for row, state, errors in self.segments
+                for line_number, offset, text, name in errors]
+
+    def check_from(self, row, state, edited=None, old=(), delta=0):
+        """
+        Check the lines after row, from the state saved there.  After the
+        edited lines, stop at the first segment of old which starts with
+        the same state (and its row shifted by delta), and reuse it.
+        """
+        checker = self.checker
+        checker.lines = self.lines
+        checker.line_number = row
+        (checker.indent_char, checker.indent_level, checker.previous_logical,
+         checker.comment, indents) = state
+        checker.expected = ()
+        checker.line_offset = 0
+        checker.file_errors = 0
+        checker.blank_lines = 0
+        checker.blank_lines_before_comment = 0
+        checker.tokens = []
+        checker.physical_candidates = None
+        checker.recorded_errors = []
+        self.segments.append([row, state, checker.recorded_errors])
+        old_rows = dict([(segment[0] + delta, index)
+                         for index, segment in enumerate(old)])
+        reused = []
+        indents = list(indents)
+        # Open the enclosing blocks again, then read the lines after row
+        prelude = [indent + 'if 1:\n' for indent in [''] + indents[:-1]]
+        if indents:
+            prelude.append(indents[-1] + 'pass\n')
+        prelude.reverse()
+        shift = row - len(prelude)
+
+        def readline():
+            if prelude:
+                return prelude.pop()
+            return checker.readline_check_physical()
+
+        def tokens():
+            for token in tokenize.generate_tokens(readline):
+                token_type, text, start, end, line = token
+                if start[0] + shift <= row:
+                    continue
+                if token_type == tokenize.INDENT:
+                    indents.append(text)
+                elif token_type == tokenize.DEDENT:
+                    indents.pop()
+                yield (token_type, text, (start[0] + shift, start[1]),
+                       (end[0] + shift, end[1]), line)
+
+        def resync():
+            row = checker.line_number
+            state = (checker.indent_char, checker.indent_level,
+                     checker.previous_logical, checker.comment,
+                     tuple(indents))
+            index = old_rows.get(row)
+            if (edited is not None and row >= edited and
+                    index is not None and old[index][1] == state):
+                for old_row, state, errors in old[index:]:
+                    reused.append([old_row + delta, state, [
+                        (line_number + delta, offset, text, name)
+                        for line_number, offset, text, name in errors]])
+                return True
+            checker.recorded_errors = []
+            self.segments.append([row, state, checker.recorded_errors])
+        checker.resync = resync
+        try:
+            checker.check_tokens(tokens())
+        except (tokenize.TokenError, SyntaxError):
+            # Incomplete code while typing: report the errors found so far
+            pass
+        checker.resync = None
+        self.segments.extend(reused)
+
+
+def input_file(filename, options=None):
+    """
+    Run all checks on a Python source file.
+    """
+    options = command_line_options(options)
+    if options.verbose:
+        message('checking ' + filename)
+    if options.cache is None:
+        reuse_checker(filename, options=options).check_all()
+        return
+    key, result = options.cache.lookup(filename)
+    if result is None:
+        try:
+            result = check_file(filename, options=options)
+        except Exception:
+            report_partial_result(filename, sys.exc_info()[1], options)
+            raise
+        options.cache.store(key, result)
+    report_result(filename, result, options=options)
+
+
+def input_stdin():
+    """
+    Run all checks on Python source code read from standard input.
+    """
+    Checker(None, sys.stdin.readlines(), options).check_all()
+
+
+def check_file(filename, lines=None, expected=None, line_offset=0,
+               options=None):
+    """
+    Run all checks on a Python source file, recording the errors.
+
+    Errors are recorded instead of reported, so that they can be reported
+    later by report_result(), in the same order as in a serial run.  If
+    checking raises, the result so far is stored in the partial_result
+    attribute of the exception, for report_partial_result().
+    """
+    options = command_line_options(options)
+    counters = options.counters
+    physical_lines = counters['physical lines']
+    logical_lines = counters['logical lines']
+    checker = reuse_checker(filename, lines, options)
+    checker.recorded_errors = []
+    try:
+        checker.check_all(expected, line_offset)
+    except Exception:
+        sys.exc_info()[1].partial_result = (
+            counters['physical lines'] - physical_lines,
+            counters['logical lines'] - logical_lines,
+            checker.recorded_errors)
+        raise
+    return (counters['physical lines'] - physical_lines,
+            counters['logical lines'] - logical_lines,
+            checker.recorded_errors)
+
+
+def report_result(filename, result, lines=None, expected=(), line_offset=0,
+                  options=None):
+    """
+    Count and report the result of check_file().  Return the number of
+    errors reported.
+    """
+    options = command_line_options(options)
+    physical_lines, logical_lines, errors = result
+    options.counters['physical lines'] += physical_lines
+    options.counters['logical lines'] += logical_lines
+    checker = reuse_checker(filename, lines or [], options)
+    if errors and options.show_source and lines is None:
+        checker.lines = readlines(filename)
+    return checker.replay_errors(errors, expected, line_offset)
+
+
+def report_partial_result(filename, error, options=None):
+    """
+    Report the errors found in a file before checking it raised error, as
+    a serial run does before the traceback.
+    """
+    result = getattr(error, 'partial_result', None)
+    if result is not None:
+        report_result(filename, result, options=options)
+
+
+def report_check_error(filename, error, results=None, keep_going=False):
+    """
+    Report the errors found in a file before checking it raised error.
+    Return true if checking can go on with the other files: with
+    keep_going, if error is one of CHECK_ERRORS.  Then the error is
+    reported too, and the result so far is stored in results.
+    """
+    report_partial_result(filename, error)
+    if not (keep_going and isinstance(error, CHECK_ERRORS)):
+        return False
+    name = error.__class__.__name__
+    if isinstance(error, tokenize.TokenError):
+        text, (row, column) = error.args
+        message('%s:%d:%d: %s: %s' % (filename, row, column + 1, name, text))
+    elif isinstance(error, SyntaxError):
+        message('%s:%s: %s: %s' % (filename, error.lineno, name, error.msg))
+    else:
+        message('%s: %s: %s' % (filename, name, error))
+    if results is not None:
+        results.pop(filename, None)
+        result = getattr(error, 'partial_result', None)
+        if result is not None:
+            results[filename] = result
+    return True
+
+
+def reuse_checker(filename, lines=None, options=None):
+    """
+    Return the Checker of this process, reset to check another file.
+    """
+    global checker
+    options = command_line_options(options)
+    if checker is None or checker.options is not options:
+        checker = Checker(filename, lines, options)
+    else:
+        checker.reset(filename, lines)
+    return checker
+
+
+def input_files(filenames, results=None, keep_going=False):
+    """
+    Run all checks on Python source files, using the result cache and
+    options.jobs processes.  The filenames can be any iterable, checking
+    starts before it is exhausted.  The result of each file is stored in
+    the results dict, if given.
+
+    With keep_going, a file which cannot be checked, e.g. because it does
+    not tokenize, does not stop the others, see report_check_error().
+
+    The output and the counters are the same as for a serial run.
+    """
+    cache = options.cache
+    pool = None
+    # (filename, cache key, result or AsyncResult) in the input order
+    pending = deque()
+    try:
+        for filename in filenames:
+            key = result = None
+            if cache is not None:
+                key, result = cache.lookup(filename)
+            if result is None:
+                if pool is None and options.jobs > 1:
+                    pool = start_pool()
+                if pool is None:
+                    try:
+                        result = check_file(filename)
+                    except Exception:
+                        if not report_check_error(filename, sys.exc_info()[1],
+                                                  results, keep_going):
+                            raise
+                        continue
+                    if cache is not None:
+                        cache.store(key, result)
+                else:
+                    result = pool.apply_async(check_file, (filename,))
+            pending.append((filename, key, result))
+            while pending and (isinstance(pending[0][2], tuple) or
+                               pending[0][2].ready()):
+                report_pending(pending.popleft(), results, keep_going)
+        while pending:
+            report_pending(pending.popleft(), results, keep_going)
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def report_pending(entry, results=None, keep_going=False):
+    """
+    Report a result of input_files(), waiting for the worker process.
+    """
+    filename, key, result = entry
+    if not isinstance(result, tuple):
+        try:
+            result = result.get()
+        except Exception:
+            if not report_check_error(filename, sys.exc_info()[1],
+                                      results, keep_going):
+                raise
+            return
+        if options.cache is not None:
+            options.cache.store(key, result)
+    if results is not None:
+        results[filename] = result
+    report_result(filename, result)
+
+
+def start_pool():
+    """
+    Return a pool of options.jobs worker processes.  If multiprocessing
+    is unavailable (before Python 2.6), set options.jobs to 1 and return
+    None, so that the caller checks serially.
+    """
+    try:
+        import multiprocessing
+    except ImportError:
+        options.jobs = 1
+        return None
+    return multiprocessing.Pool(options.jobs, init_worker,
+                                (options.settings,))
+
+
+def init_worker(settings):
+    """
+    Set up a worker process of start_pool().  A forked worker already has
+    the options of its parent.  A spawned worker (the only start method
+    on Windows) imports this module again, so it builds its options from
+    the settings.
+    """
+    global options
+    if options is None:
+        options = init_options(Values(settings))
+
+
+def default_jobs():
+    """
+    Return the number of CPUs.  Ask the system first, since importing
+    multiprocessing takes a few milliseconds which a run checking one
+    file does not need; start_pool() falls back to checking serially if
+    multiprocessing turns out to be unavailable.
+    """
+    try:
+        return max(1, os.sysconf('SC_NPROCESSORS_ONLN'))
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def input_dir(dirname, runner=None):
+    """
+    Check all Python source files in this directory and all subdirectories.
+    """
+    if runner is None:
+        runner = input_file
+    for filename in walk_dir(dirname, options):
+        runner(filename)
+
+
+def input_paths(paths, options):
+    """
+    Generate the names of the Python source files given on the command
+    line, walking the directories.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in walk_dir(path, options):
+                yield filename
+        elif not excluded(path, options):
+            options.counters['files'] += 1
+            yield path
+
+
+def read_file_list(filename):
+    """
+    Generate the paths listed in a file, or in standard input if filename
+    is '-', as they are read: checking starts before the list is complete.
+    The paths are separated by newlines, or by NUL characters if a NUL
+    comes first, as written by 'find -print0' or 'git ls-files -z'.
+    Empty paths, e.g. blank lines, are skipped.
+    """
+    empty = ''.encode()
+    newline = '\n'.encode()
+    nul = '\0'.encode()
+    separator = None
+    pending = empty
+    for chunk in read_chunks(filename):
+        if not isinstance(chunk, type(empty)):
+            chunk = chunk.encode(sys.getfilesystemencoding())
+        pending += chunk
+        if separator is None:
+            if nul in pending.split(newline, 1)[0]:
+                separator = nul
+            elif newline in pending:
+                separator = newline
+            else:
+                continue
+        paths = pending.split(separator)
+        pending = paths.pop()
+        for path in paths:
+            path = decode_path(path, separator)
+            if path:
+                yield path
+    if pending:
+        path = decode_path(pending, separator)
+        if path:
+            yield path
+
+
+def read_chunks(filename):
+    """
+    Generate the content of a file, or of standard input if filename is
+    '-', in chunks of at most FILE_LIST_CHUNK_SIZE bytes.  Each chunk is
+    returned as soon as it is read, without waiting for a full chunk.
+    """
+    if filename == '-':
+        try:
+            fd = sys.stdin.fileno()
+        except (AttributeError, ValueError):
+            # Standard input is a string, see serve()
+            yield sys.stdin.read()
+            return
+    else:
+        fd = os.open(filename, os.O_RDONLY)
+    while True:
+        chunk = read_chunk(fd, filename != '-')
+        if not chunk:
+            break
+        yield chunk
+
+
+def read_chunk(fd, close):
+    """
+    Read a chunk of read_chunks().  If close is true, close the file at
+    its end or if reading fails: a generator cannot yield in a try block
+    with a finally clause before Python 2.5.
+    """
+    chunk = None
+    try:
+        chunk = os.read(fd, FILE_LIST_CHUNK_SIZE)
+    finally:
+        if close and not chunk:
+            os.close(fd)
+    return chunk
+
+
+def decode_path(path, separator):
+    """
+    Return a path of a file list as a string, without the carriage return
+    of a line ending with CRLF.
+    """
+    if separator != '\0'.encode():
+        path = path.rstrip('\r'.encode())
+    if not isinstance(path, str):
+        path = path.decode(sys.getfilesystemencoding())  # Python 3
+    return path
+
+
+if scandir is not None:
+    def list_dir(dirname):
+        """
+        Return the sorted names of subdirectories and other files.
+        """
+        dirs = []
+        files = []
+        for entry in scandir(dirname):
+            if entry.is_dir():
+                dirs.append(entry.name)
+            else:
+                files.append(entry.name)
         dirs.sort()
-        for subdir in dirs:
-            if excluded(subdir):
-                dirs.remove(subdir)
         files.sort()
+        return dirs, files
+else:
+    def list_dir(dirname):
+        """
+        Return the sorted names of subdirectories and other files.
+        """
+        dirs = []
+        files = []
+        for name in os.listdir(dirname):
+            if os.path.isdir(os.path.join(dirname, name)):
+                dirs.append(name)
+            else:
+                files.append(name)
+        dirs.sort()
+        files.sort()
+        return dirs, files
+
+
+def walk_dir(dirname, options):
+    """
+    Generate the names of the Python source files in this directory and
+    all subdirectories, in the same order as os.walk().
+
+    Excluded directories are not entered.  Symbolic links to directories
+    are followed, but each directory is visited only once.
+    """
+    dirname = dirname.rstrip('/')
+    if excluded(dirname, options):
+        return
+    visited = set()
+    stack = [dirname]
+    while stack:
+        root = stack.pop()
+        try:
+            stat = os.stat(root)
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            dirs, files = list_dir(root)
+        except OSError:
+            continue
+        if options.verbose:
+            message('directory ' + root)
+        options.counters['directories'] += 1
         for filename in files:
-            if filename_match(filename) and not excluded(filename):
+            if (filename_match(filename, options) and
+                not excluded(filename, options)):
                 options.counters['files'] += 1
-                runner(os.path.join(root, filename))
+                yield os.path.join(root, filename)
+        for subdir in reversed(dirs):
+            if not excluded(subdir, options):
+                stack.append(os.path.join(root, subdir))
+
 
+def compile_patterns(patterns):
+    """
+    Compile shell-style patterns into one regular expression, which
+    matches a name if any of the patterns matches it.
 
-def excluded(filename):
+    >>> bool(compile_patterns(['*.py', '.git']).match('.git'))
+    True
+    >>> bool(compile_patterns(['*.py', '.git']).match('.gitignore'))
+    False
+    """
+    regexes = ['(?:%s)' % translate(os.path.normcase(pattern))
+               for pattern in patterns]
+    return re.compile('|'.join(regexes))
+
+
+def parse_diff(diff):
+    """
+    Return a dictionary that maps each file in a unified diff without
+    context lines to the set of line numbers which were added or changed.
+
+    >>> parse_diff('+++ b/a.py\\n@@ -1 +1,2 @@\\n-x\\n+++ x\\n+y\\n')
+    {'a.py': set([1, 2])}
+    """
+    result = {}
+    lines = None
+    remaining = 0
+    for line in diff.splitlines():
+        if remaining:
+            # Skip removed and added lines of the current hunk
+            if line[:1] in '-+':
+                remaining -= 1
+            continue
+        if line.startswith('+++ '):
+            filename = line[4:].rstrip('\t')
+            if filename.startswith('b/'):
+                lines = result.setdefault(filename[2:], set())
+            else:
+                lines = None  # /dev/null for deleted files
+            continue
+        match = HUNK_REGEX.match(line)
+        if match:
+            old_count, start, count = [int(group or 1)
+                                       for group in match.groups()]
+            remaining = old_count + count
+            if lines is not None:
+                lines.update(range(start, start + count))
+    return result
+
+
+def git_diff(git_args):
+    """
+    Run git diff with these arguments, and parse its output.
+    Filenames are relative to the current directory.
+    """
+    import subprocess
+    command = ['git', 'diff', '--no-color', '--no-ext-diff', '--relative',
+               '-U0'] + git_args
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    output = process.communicate()[0]
+    if process.returncode:
+        return None
+    return parse_diff(output)
+
+
+def excluded(filename, options):
     """
     Check if options.exclude contains a pattern that matches filename.
     """
-    basename = os.path.basename(filename)
-    for pattern in options.exclude:
-        if fnmatch(basename, pattern):
-            # print basename, 'excluded because it matches', pattern
-            return True
+    basename = os.path.normcase(os.path.basename(filename))
+    return options.exclude_regex.match(basename) is not None
 
 
-def filename_match(filename):
+def filename_match(filename, options):
     """
     Check if options.filename contains a pattern that matches filename.
     If options.filename is unspecified, this always returns True.
     """
     if not options.filename:
         return True
-    for pattern in options.filename:
-        if fnmatch(filename, pattern):
-            return True
+    basename = os.path.normcase(filename)
+    return options.filename_regex.match(basename) is not None
 
 
-def ignore_code(code):
+def ignore_code(code, options):
     """
     Check if options.ignore contains a prefix of the error code.
     If options.select contains a prefix of the error code, do not ignore it.
+
+    The decision is looked up in options.ignored_codes, which maps the
+    codes of all registered checks (and any other code seen so far) to
+    True or False.
+    """
+    try:
+        return options.ignored_codes[code]
+    except KeyError:
+        ignored = match_ignore_prefixes(code, options)
+        options.ignored_codes[code] = ignored
+        return ignored
+
+
+def match_ignore_prefixes(code, options):
+    """
+    Decide if the error code is ignored, according to the prefixes in
+    options.select and options.ignore.
     """
     for select in options.select:
         if code.startswith(select):
@@ -1385,6 +3057,98 @@ def ignore_code(code):
     for ignore in options.ignore:
         if code.startswith(ignore):
             return True
+    return False
+
+
+def build_ignored_codes(options):
+    """
+    Build the table of ignore_code() decisions for the codes of all
+    registered checks.
+    """
+    ignored_codes = {}
+    for check in Check.all_checks:
+        for code in check.codes:
+            ignored_codes[code] = match_ignore_prefixes(code, options)
+    return ignored_codes
+
+
+def watch(paths):
+    """
+    Check the files in paths, then poll them every WATCH_INTERVAL seconds
+    and check again the files whose mtime or size changed, until
+    interrupted.  The results of all files are kept, so that after each
+    change the errors in the changed files are reported, followed by the
+    number of errors in all files and its change, see print_watch_counts().
+    A file which does not tokenize, as often while it is edited, is
+    reported with the errors found before the failure.
+    """
+    stamps = {}
+    results = {}
+    counts = None
+    messages = {}
+    try:
+        while True:
+            found = {}
+            changed = []
+            for filename in input_paths(paths, options):
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                found[filename] = (stat.st_mtime, stat.st_size)
+                if stamps.get(filename) != found[filename]:
+                    changed.append(filename)
+            removed = [filename for filename in stamps
+                       if filename not in found]
+            stamps = found
+            if changed or removed:
+                for filename in removed:
+                    del results[filename]
+                reset_counters()
+                input_files(changed, results, keep_going=True)
+                options.reporter.end()
+                counts = print_watch_counts(results, counts, messages)
+                sys.stdout.flush()
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+
+def print_watch_counts(results, previous=None, messages=None):
+    """
+    Print the number of errors and warnings in the results of watch(),
+    and how much it changed since the previous counts.  With --statistics,
+    also print the count of each error code which changed.  Return the
+    counts by error code.
+
+    The text of each error code is added to messages, which watch() keeps
+    from one round to the next, for the codes whose count dropped to zero.
+    """
+    counts = {}
+    if messages is None:
+        messages = {}
+    files = 0
+    for physical_lines, logical_lines, errors in results.values():
+        if errors:
+            files += 1
+        for line_number, offset, text, name in errors:
+            code = text[:4]
+            counts[code] = counts.get(code, 0) + 1
+            messages[code] = text[5:]
+    total = sum(counts.values())
+    summary = '%d errors and warnings in %d of %d files' % (
+        total, files, len(results))
+    if previous is not None:
+        summary += ' (%+d)' % (total - sum(previous.values()))
+        if options.statistics:
+            for code in sorted(set(counts) | set(previous)):
+                delta = counts.get(code, 0) - previous.get(code, 0)
+                if delta:
+                    print('%-7s %-7s %s %s' % (
+                        counts.get(code, 0), '(%+d)' % delta, code,
+                        messages.get(code, '')))
+    message(summary)
+    return counts
 
 
 def reset_counters():
@@ -1439,6 +3203,29 @@ def print_statistics(prefix=''):
         print(line)
 
 
+def print_diff(filename, original, fixed):
+    """
+    Print the changes to a file as a unified diff, for patch -p1.
+
+    The path in the headers is relative to the current directory, or to
+    the root for files outside of it.
+    """
+    import difflib
+    path = os.path.abspath(filename)
+    cwd = os.path.join(os.getcwd(), '')
+    if path.startswith(cwd):
+        path = path[len(cwd):]
+    else:
+        path = os.path.splitdrive(path)[1].lstrip(os.sep)
+    path = path.replace(os.sep, '/')
+    for line in difflib.unified_diff(
+            original.splitlines(True), fixed.splitlines(True),
+            'a/' + path, 'b/' + path):
+        if not line.endswith('\n'):
+            line += '\n\\ No newline at end of file\n'
+        sys.stdout.write(line)
+
+
 def print_benchmark(elapsed):
     """
     Print benchmark numbers.
@@ -1450,6 +3237,65 @@ def print_benchmark(elapsed):
             options.counters[key]))
 
 
+def benchmark_startup(runs=STARTUP_RUNS):
+    """
+    Print the time taken to start pep8 and check an empty input, compared
+    with the time taken to start the interpreter alone.
+    """
+    import subprocess
+    path = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=path)
+    commands = [('python', 'pass'),
+                ('pep8', 'import pep8; pep8._main(["-"])')]
+    devnull = open(os.devnull)
+    try:
+        for name, code in commands:
+            timings = []
+            for run in range(runs):
+                start_time = time.time()
+                subprocess.call([sys.executable, '-c', code],
+                                stdin=devnull, env=env)
+                timings.append(time.time() - start_time)
+            timings.sort()
+            print('%-7.1f %-7.1f %s' % (timings[0] * 1000,
+                                        timings[runs // 2] * 1000, name))
+    finally:
+        devnull.close()
+
+
+def print_check_profile():
+    """
+    Print the time spent in each check, most expensive first.  The rows
+    named check.candidates are the scans of the physical checks for the
+    lines where they may find errors, and logical_scanner is the scan of
+    the logical lines for the candidates of the logical checks.
+    """
+    print('%-7s %-9s %-7s %-9s %-9s %s' % (
+        'seconds', 'calls', 'hits', 'mean (us)', 'max (ms)', 'check'))
+    for name, (calls, hits, total, maximum) in sorted(
+            options.check_profile.items(), key=lambda item: -item[1][2]):
+        print('%-7.3f %-9d %-7d %-9.2f %-9.3f %s' % (
+            total, calls, hits, total * 1e6 / max(calls, 1), maximum * 1e3,
+            name))
+
+
+def write_check_profile(filename):
+    """
+    Write the time spent in each check to a JSON file.
+    """
+    import json
+    profile = {}
+    for name, (calls, hits, total, maximum) in options.check_profile.items():
+        profile[name] = {'calls': calls, 'hits': hits,
+                         'time': total, 'max_time': maximum}
+    output = open(filename, 'w')
+    try:
+        json.dump(profile, output, indent=1, sort_keys=True)
+        output.write('\n')
+    finally:
+        output.close()
+
+
 def run_tests(filename):
     """
     Run all the tests from a file.
@@ -1468,6 +3314,14 @@ def run_tests(filename):
      * Following example is conform:            #: Okay
      * Don't check these lines:                 #:
     """
+    run_test_files([filename])
+
+
+def test_cases(filename):
+    """
+    Generate the tests of a file, see run_tests(): tuples (filename,
+    lines, expected codes, line offset).
+    """
     lines = readlines(filename) + ['#:\n']
     line_offset = 0
     codes = ['Okay']
@@ -1479,33 +3333,98 @@ def run_tests(filename):
                 testcase.append(line)
             continue
         if codes and index > 0:
-            label = '%s:%s:1' % (filename, line_offset + 1)
-            codes = [c for c in codes if c != 'Okay']
-            # Run the checker
-            errors = Checker(filename, testcase).check_all(codes, line_offset)
-            # Check if the expected errors were found
-            for code in codes:
-                if not options.counters.get(code):
-                    errors += 1
-                    message('%s: error %s not found' % (label, code))
-            if options.verbose and not errors:
-                message('%s: passed (%s)' % (label, ' '.join(codes)))
-            # Keep showing errors for multiple tests
-            reset_counters()
+            yield (filename, testcase, [c for c in codes if c != 'Okay'],
+                   line_offset)
         # output the real line numbers
         line_offset = index
         # configure the expected errors
         codes = line.split()[1:]
-        # empty the test case buffer
-        del testcase[:]
+        testcase = []
+
+
+def check_test_case(case):
+    """
+    Run all checks on a test case, recording the errors.  Return the
+    result of check_file() and the seconds it took.
+    """
+    filename, lines, codes, line_offset = case
+    start = time.time()
+    result = check_file(filename, lines, codes, line_offset)
+    return result, time.time() - start
+
+
+def map_test_cases(cases, report):
+    """
+    Run check_test_case() on each of cases, in options.jobs processes,
+    and call report(index, result, seconds) for each of them in order.
+
+    Each test case runs with its own counters: the errors are recorded,
+    and counted when report() replays them.  Worker processes are only
+    started for the tests which remain after TEST_SERIAL_SECONDS.
+    """
+    serial = (options.jobs < 2 or options.verbose or
+              options.profile_checks)
+    deadline = time.time() + TEST_SERIAL_SECONDS
+    index = 0
+    while index < len(cases) and (serial or time.time() < deadline):
+        result, seconds = check_test_case(cases[index])
+        report(index, result, seconds)
+        index += 1
+    if index == len(cases):
+        return
+    pool = start_pool()
+    if pool is None:
+        for index in range(index, len(cases)):
+            result, seconds = check_test_case(cases[index])
+            report(index, result, seconds)
+        return
+    try:
+        results = pool.imap(check_test_case, cases[index:],
+                            TEST_CHUNK_SIZE)
+        for result, seconds in results:
+            report(index, result, seconds)
+            index += 1
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def run_test_files(filenames):
+    """
+    Run all the tests from files, see run_tests().  With --benchmark,
+    print the slowest tests and the time spent on each file.
+    """
+    cases = [case for filename in filenames
+             for case in test_cases(filename)]
+    timings = []
+
+    def report(index, result, seconds):
+        filename, lines, codes, line_offset = cases[index]
+        label = '%s:%s:1' % (filename, line_offset + 1)
+        errors = report_result(filename, result, lines, codes, line_offset)
+        # Check if the expected errors were found
+        for code in codes:
+            if not options.counters.get(code):
+                errors += 1
+                message('%s: error %s not found' % (label, code))
+        if options.verbose and not errors:
+            message('%s: passed (%s)' % (label, ' '.join(codes)))
+        # Keep showing errors for multiple tests
+        reset_counters()
+        timings.append((seconds, label, filename))
+    map_test_cases(cases, report)
+    if options.benchmark:
+        print_test_timings(timings, 'file')
 
 
 def selftest():
     """
     Test all check functions with test cases in docstrings.
     """
-    count_passed = 0
-    count_failed = 0
+    cases = []
+    # (check name, code) of each test case
+    examples = []
     checks = options.physical_checks + options.logical_checks
     for name, check, argument_names in checks:
         for line in check.__doc__.splitlines():
@@ -1514,47 +3433,77 @@ def selftest():
             if match is None:
                 continue
             code, source = match.groups()
-            checker = Checker(None)
+            lines = []
             for part in source.split(r'\n'):
                 part = part.replace(r'\t', '\t')
                 part = part.replace(r'\s', ' ')
-                checker.lines.append(part + '\n')
-            options.quiet = 2
-            checker.check_all()
-            error = None
-            if code == 'Okay':
-                if len(options.counters) > len(BENCHMARK_KEYS):
-                    codes = [key for key in options.counters.keys()
-                             if key not in BENCHMARK_KEYS]
-                    error = "incorrectly found %s" % ', '.join(codes)
-            elif not options.counters.get(code):
-                error = "failed to find %s" % code
-            # Reset the counters
-            reset_counters()
-            if not error:
-                count_passed += 1
-            else:
-                count_failed += 1
-                if len(checker.lines) == 1:
-                    print("pep8.py: %s: %s" %
-                          (error, checker.lines[0].rstrip()))
-                else:
-                    print("pep8.py: %s:" % error)
-                    for line in checker.lines:
-                        print(line.rstrip())
+                lines.append(part + '\n')
+            cases.append((None, lines, None, 0))
+            examples.append((name, code))
+    counts = [0, 0]
+    timings = []
+
+    def report(index, result, seconds):
+        lines = cases[index][1]
+        name, code = examples[index]
+        found = {}
+        for line_number, offset, text, check_name in result[2]:
+            found[text[:4]] = True
+        error = None
+        if code == 'Okay':
+            if found:
+                codes = sorted(found.keys())
+                error = "incorrectly found %s" % ', '.join(codes)
+        elif code not in found:
+            error = "failed to find %s" % code
+        timings.append((seconds, '%s: %s' % (name, code), name))
+        if not error:
+            counts[0] += 1
+            return
+        counts[1] += 1
+        if len(lines) == 1:
+            print("pep8.py: %s: %s" % (error, lines[0].rstrip()))
+        else:
+            print("pep8.py: %s:" % error)
+            for line in lines:
+                print(line.rstrip())
+    map_test_cases(cases, report)
+    count_passed, count_failed = counts
     if options.verbose:
         print("%d passed and %d failed." % (count_passed, count_failed))
         if count_failed:
             print("Test failed.")
         else:
             print("Test passed.")
+    if options.benchmark:
+        print_test_timings(timings, 'check')
 
 
-def process_options(arglist=None):
+def print_test_timings(timings, group_name, count=10):
     """
-    Process options passed either via arglist or via command line args.
+    Print the slowest test cases, then the time spent on each group of
+    them, slowest first.  The timings are tuples (seconds, label, group).
+    """
+    timings = sorted(timings, key=lambda timing: -timing[0])
+    print('%-9s %s' % ('ms', 'slowest tests'))
+    for seconds, label, group in timings[:count]:
+        print('%-9.3f %s' % (seconds * 1e3, label))
+    totals = {}
+    for seconds, label, group in timings:
+        total = totals.setdefault(group, [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+    print('%-9s %-7s %s' % ('ms', 'tests', group_name))
+    for group, (seconds, tests) in sorted(
+            totals.items(), key=lambda item: -item[1][0]):
+        print('%-9.3f %-7d %s' % (seconds * 1e3, tests, group))
+
+
+def get_parser():
+    """
+    Build the parser of the command line options.  StyleGuide also uses
+    it for the defaults of its settings.
     """
-    global options, args
     parser = OptionParser(version=__version__,
                           usage="%prog [options] input ...")
     parser.add_option('-v', '--verbose', default=0, action='count',
@@ -1571,6 +3520,10 @@ def process_options(arglist=None):
                       help="when parsing directories, only check filenames "
                         "matching these comma separated patterns (default: "
                         "*.py)")
+    parser.add_option('--files-from', metavar='file',
+                      help="also check the paths listed in file, or in "
+                        "standard input if '-', one per line or separated "
+                        "by NUL characters")
     parser.add_option('--select', metavar='errors', default='',
                       help="select errors and warnings (e.g. E,W6)")
     parser.add_option('--ignore', metavar='errors', default='',
@@ -1579,6 +3532,11 @@ def process_options(arglist=None):
                       help="show source code for each error")
     parser.add_option('--show-pep8', action='store_true',
                       help="show text of PEP 8 for each error")
+    parser.add_option('--format', type='choice', default='default',
+                      choices=sorted(REPORTERS),
+                      help="report errors as text (default), JSON Lines "
+                        "(jsonl) or SARIF (sarif); the last two report "
+                        "every error, as with --repeat")
     parser.add_option('--statistics', action='store_true',
                       help="count errors and warnings")
     parser.add_option('--count', action='store_true',
@@ -1587,6 +3545,37 @@ def process_options(arglist=None):
                         "total is not null")
     parser.add_option('--benchmark', action='store_true',
                       help="measure processing speed")
+    parser.add_option('--benchmark-startup', action='store_true',
+                      help="measure the startup time, in milliseconds "
+                        "(best and median of %d runs)" % STARTUP_RUNS)
+    parser.add_option('--profile-checks', action='store_true',
+                      help="measure the time spent in each check; files "
+                        "are checked serially and without the cache")
+    parser.add_option('--profile-json', metavar='filename',
+                      help="write the measures of --profile-checks to "
+                        "filename as JSON")
+    parser.add_option('--diff', action='store_true',
+                      help="check only files and lines changed according to "
+                        "git diff; the arguments are passed to git diff "
+                        "(default: HEAD)")
+    parser.add_option('--cache-dir', metavar='dir',
+                      help="cache the results of unchanged files in dir")
+    parser.add_option('--cache-size', metavar='megabytes', type='int',
+                      default=DEFAULT_CACHE_SIZE,
+                      help="maximum size of the cache (default: %d)" %
+                        DEFAULT_CACHE_SIZE)
+    parser.add_option('--serve', metavar='socket',
+                      help="run as a server on this Unix socket, to avoid "
+                        "the startup time of each run")
+    parser.add_option('--connect', metavar='socket',
+                      help="let the server on this Unix socket do the work")
+    parser.add_option('--jobs', metavar='n', type='int',
+                      default=default_jobs(),
+                      help="check files in n parallel processes "
+                        "(default: number of CPUs)")
+    parser.add_option('--watch', action='store_true',
+                      help="check the input again when files change, "
+                        "until interrupted")
     parser.add_option('--testsuite', metavar='dir',
                       help="run regression tests from dir")
     parser.add_option('--doctest', action='store_true',
@@ -1596,24 +3585,42 @@ def process_options(arglist=None):
     parser.add_option('-i', '--inplace', action='count',
                       help="use with the --fix flag. Makes modifications "
                        "in-place.")
+    parser.add_option('--diff-output', action='store_true',
+                      help="use with the --fix flag. Print the fixes as a "
+                        "unified diff instead of writing files.")
+    return parser
 
-    options, args = parser.parse_args(arglist)
-    if options.testsuite:
-        args.append(options.testsuite)
-    if not args and not options.doctest:
-        parser.error('input not specified')
-    options.prog = os.path.basename(sys.argv[0])
-    options.exclude = options.exclude.split(',')
-    for index in range(len(options.exclude)):
-        options.exclude[index] = options.exclude[index].rstrip('/')
+
+def split_option(value):
+    """
+    Split a comma separated option, unless it is already a list.
+
+    >>> split_option('E1,W'), split_option(['E1']), split_option('')
+    (['E1', 'W'], ['E1'], [])
+    """
+    if not value:
+        return []
+    if hasattr(value, 'split'):
+        return value.split(',')
+    return list(value)
+
+
+def init_options(options):
+    """
+    Complete parsed options with what is derived from them: the patterns,
+    the selected checks and their plans, the counters and the reporter.
+    The parsed settings are kept, for the worker processes of start_pool().
+    """
+    options.settings = dict(options.__dict__)
+    options.exclude = [pattern.rstrip('/')
+                       for pattern in split_option(options.exclude)]
+    options.exclude_regex = compile_patterns(options.exclude)
     if options.filename:
-        options.filename = options.filename.split(',')
-    if options.select:
-        options.select = options.select.split(',')
-    else:
-        options.select = []
+        options.filename = split_option(options.filename)
+        options.filename_regex = compile_patterns(options.filename)
+    options.select = split_option(options.select)
     if options.ignore:
-        options.ignore = options.ignore.split(',')
+        options.ignore = split_option(options.ignore)
     elif options.select:
         # Ignore all checks which are not explicitly selected
         options.ignore = ['']
@@ -1623,38 +3630,246 @@ def process_options(arglist=None):
     else:
         # The default choice: ignore controversial checks
         options.ignore = DEFAULT_IGNORE.split(',')
-    options.physical_checks = find_checks('physical_line')
-    options.logical_checks = find_checks('logical_line')
+    options.diff_lines = None
+    load_plugins(options)
+    options.ignored_codes = build_ignored_codes(options)
+    options.physical_checks = find_checks('physical_line', options)
+    options.logical_checks = find_checks('logical_line', options)
+    options.physical_plan = build_plan(options.physical_checks)
+    options.logical_plan = build_plan(options.logical_checks, scanned=True)
+    options.logical_scanner = build_scanner(options.logical_checks)
+    if options.profile_json:
+        options.profile_checks = True
+    options.check_profile = None
+    if options.profile_checks:
+        options.check_profile = profile = {}
+        options.physical_plan = [
+            (name, check, argument_names, profile_check(name, run, profile))
+            for name, check, argument_names, run in options.physical_plan]
+        # Count only the calls of the logical checks which really run
+        options.logical_plan = [
+            (name, check, argument_names,
+             profile_check(name, compile_check(check, argument_names),
+                           profile, check.candidate_regex is not None and
+                           check or None))
+            for name, check, argument_names in options.logical_checks]
+        options.logical_scanner = profile_scan(
+            'logical_scanner', options.logical_scanner, profile)
+    options.checks_by_name = {}
+    for name, check, argument_names in (options.physical_checks +
+                                        options.logical_checks):
+        options.checks_by_name[name] = check
     options.counters = dict.fromkeys(BENCHMARK_KEYS, 0)
     options.messages = {}
+    if options.format != 'default':
+        options.repeat = True
+    options.reporter = REPORTERS[options.format](options)
+    options.cache = None
+    return options
+
+
+def process_options(arglist=None):
+    """
+    Process options passed either via arglist or via command line args.
+    """
+    global options, args
+    parser = get_parser()
+    options, args = parser.parse_args(arglist)
+    options.prog = os.path.basename(sys.argv[0])
+    if options.diff_output:
+        if not options.fix:
+            parser.error('--diff-output requires --fix')
+        # Keep the diff clean of error reports
+        options.quiet = 2
+    if options.serve or options.connect:
+        return options, args
+    if options.testsuite:
+        args.append(options.testsuite)
+    if not (args or options.diff or options.doctest or
+            options.benchmark_startup or options.files_from):
+        parser.error('input not specified')
+    if options.watch and (options.fix or options.testsuite or
+                          options.format == 'sarif' or '-' in args or
+                          options.files_from == '-'):
+        parser.error('--watch cannot be used with --fix, --testsuite, '
+                     '--format=sarif or standard input')
+    if options.format != 'default' and (options.statistics or
+                                        options.benchmark or
+                                        options.profile_checks):
+        # These print text to standard output, after the JSON
+        parser.error('--statistics, --benchmark and --profile-checks '
+                     'cannot be used with --format=%s' % options.format)
+    if options.files_from == '-' and '-' in args:
+        parser.error('standard input cannot be both an input and '
+                     'the list of files')
+    init_options(options)
+    if options.diff:
+        options.diff_lines = git_diff(args or ['HEAD'])
+        if options.diff_lines is None:
+            parser.error('git diff failed')
+        args = [filename for filename in sorted(options.diff_lines)
+                if filename_match(os.path.basename(filename), options) and
+                os.path.isfile(filename)]
+    if options.cache_dir and not (options.fix or options.testsuite or
+                                  options.profile_checks):
+        options.cache = ResultCache(options.cache_dir,
+                                    options.cache_size * 1024 * 1024,
+                                    options)
     return options, args
 
 
-def _main():
+def serve(socket_filename):
+    """
+    Run checks for clients connecting to a Unix socket, see run_client().
+
+    Each request is handled in a forked process, which inherits the
+    imported checks.  The server restarts itself when pep8.py changes.
+    """
+    import json
+    import traceback
+    from StringIO import StringIO
+    try:
+        import socketserver
+    except ImportError:
+        import SocketServer as socketserver
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            sys.stdin = StringIO(request['stdin'])
+            sys.stdout = StringIO()
+            sys.stderr = StringIO()
+            status = 0
+            try:
+                os.chdir(request['cwd'])
+                # The last --connect option wins, run the checks right here
+                _main(request['args'] + ['--connect='])
+            except SystemExit:
+                status = sys.exc_info()[1].code
+                if status is not None and not isinstance(status, int):
+                    sys.stderr.write('%s\n' % status)
+                    status = 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            response = {'stdout': sys.stdout.getvalue(),
+                        'stderr': sys.stderr.getvalue(),
+                        'status': status or 0}
+            self.wfile.write(json.dumps(response).encode())
+
+    class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+        timeout = 1
+
+    source = os.path.abspath(__file__)
+    if source.endswith('.pyc') or source.endswith('.pyo'):
+        source = source[:-1]
+    mtime = os.stat(source).st_mtime
+    if os.path.exists(socket_filename):
+        os.remove(socket_filename)
+    server = Server(socket_filename, RequestHandler)
+    try:
+        while os.stat(source).st_mtime == mtime:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(socket_filename)
+    message('%s: %s changed, restarting' % (options.prog, source))
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def run_client(socket_filename, arglist):
+    """
+    Send the arguments to the server on a Unix socket and print its
+    response.  Return the exit status.
+    """
+    import json
+    import socket
+    stdin = ''
+    if '-' in arglist or '--files-from=-' in arglist:
+        stdin = sys.stdin.read()
+    request = {'args': arglist, 'cwd': os.getcwd(), 'stdin': stdin}
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_filename)
+    connection.sendall((json.dumps(request) + '\n').encode())
+    connection.shutdown(socket.SHUT_WR)
+    chunks = []
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    connection.close()
+    response = json.loads(''.encode().join(chunks).decode())
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['status']
+
+
+def _main(arglist=None):
     """
     Parse options and run checks on Python source.
     """
-    options, args = process_options()
+    if arglist is None:
+        arglist = sys.argv[1:]
+    options, args = process_options(arglist)
+    if options.benchmark_startup:
+        benchmark_startup()
+        return
+    if options.serve:
+        serve(options.serve)
+        return
+    if options.connect:
+        sys.exit(run_client(options.connect, arglist))
     if options.doctest:
         import doctest
         doctest.testmod(verbose=options.verbose)
         selftest()
+    # Fixes and verbose output are written while checking, in order, and
+    # the profile of the checks is measured in this process
+    batch = (not (options.testsuite or options.fix or options.verbose or
+                  options.profile_checks)
+             and '-' not in args)
+    if batch and options.cache is None:
+        # Worker processes are not worth starting for a single file
+        batch = options.jobs > 1 and (len(args) > 1 or options.files_from or
+                                      (args and os.path.isdir(args[0])))
+    file_list = []
+    if options.files_from:
+        file_list = read_file_list(options.files_from)
+    if options.watch:
+        watch(args + list(file_list))
+        return
+    start_time = time.time()
     if options.testsuite:
-        runner = run_tests
+        run_test_files(input_paths(args, options))
+    elif batch:
+        from itertools import chain
+        input_files(input_paths(chain(args, file_list), options))
     else:
-        runner = input_file
-    start_time = time.time()
-    for path in args:
-        if os.path.isdir(path):
-            input_dir(path, runner=runner)
-        elif not excluded(path):
-            options.counters['files'] += 1
-            runner(path)
+        for path in args:
+            if path == '-':
+                options.counters['files'] += 1
+                input_stdin()
+            elif os.path.isdir(path):
+                input_dir(path)
+            elif not excluded(path, options):
+                options.counters['files'] += 1
+                input_file(path)
+        for filename in input_paths(file_list, options):
+            input_file(filename)
+    options.reporter.end()
+    if options.cache is not None:
+        options.cache.save()
     elapsed = time.time() - start_time
     if options.statistics:
         print_statistics()
     if options.benchmark:
         print_benchmark(elapsed)
+    if options.profile_checks:
+        print_check_profile()
+    if options.profile_json:
+        write_check_profile(options.profile_json)
     count = get_count()
     if count:
         if options.count:
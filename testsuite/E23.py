@@ -10,3 +10,5 @@ result = {
    'key1': 'value',
    'key2': 'value',
 }
+#: Okay
+b = a[1:2]  # [1:2]
@@ -13,3 +13,7 @@ foo(bar=(1 == 1))
 foo(bar=(1 != 1))
 foo(bar=(1 >= 1))
 foo(bar=(1 <= 1))
+#: E225
+(a, b)= 1, 2
+#: E225
+foo(x)(y)= 3
@@ -2,3 +2,6 @@
 if a: a = False
 #: E702
 a = False; b = True
+#: Okay
+x = 1  # {typ: [data, ...], ...}
+y = 2  # {'a': 1}